@@ -7,7 +7,7 @@ from io import TextIOWrapper
 from pathlib import Path
 from typing import Generator
 from warnings import warn
-from types import GenericAlias, EllipsisType
+from types import GenericAlias, EllipsisType, NoneType, UnionType
 
 import aiohttp
 import yaml
@@ -16,7 +16,7 @@ from pydantic.fields import FieldInfo
 from verdandi.tests.conftest import get_mocked_http
 from verdandi.widget import ALL_WIDGETS
 from verdandi.widget.abs_widget import Widget
-from verdandi.app import generate_canvas
+from verdandi.canvas import generate_canvas
 from verdandi.configuration import ApiConfiguration
 
 DOCS_PATH = Path(__file__).parent.parent.parent / "doc"
@@ -64,7 +64,9 @@ async def generate_documentation(http: aiohttp.ClientSession, docs_file: TextIOW
         example_config = [
             {
                 "name": widget.name,
-                "config": json.loads(widget.example().model_dump_json()),
+                "config": json.loads(
+                    widget.example().model_dump_json(exclude_none=True)
+                ),
             }
         ]
 
@@ -86,7 +88,15 @@ async def generate_documentation(http: aiohttp.ClientSession, docs_file: TextIOW
         for parents, field in iter_fields_flattened(widget):
             name = ".".join(parents)
             description = field.description or ""
-            type_str = getattr(field.annotation, "__name__", "")
+            annotation = field.annotation
+
+            # Optional parameters are documented with their type
+            if isinstance(annotation, UnionType):
+                annotation = next(
+                    arg for arg in typing.get_args(annotation) if arg is not NoneType
+                )
+
+            type_str = getattr(annotation, "__name__", "")
             line(f"| **{name}** | {type_str} | {description} |")
 
         line()
@@ -109,12 +119,13 @@ async def generate_example():
     path = DOCS_PATH / "images" / "example.png"
     print("Generate example at", path)
 
-    async with get_mocked_http():
+    async with get_mocked_http() as http:
         now = datetime.now().astimezone()
-        resp = await generate_canvas(ApiConfiguration.load(EXAMPLE_CONFIG_PATH), now)
+        configuration = ApiConfiguration.load(EXAMPLE_CONFIG_PATH)
+        canvas = await generate_canvas(configuration, now, http)
 
     with open(path, "wb") as f:
-        f.write(resp.body)
+        f.write(canvas.content)
 
 
 async def main():
@@ -1,111 +1,162 @@
 import logging
 import asyncio
 import os
+from contextlib import asynccontextmanager
 from datetime import datetime
-from uuid import UUID, uuid4
+from time import perf_counter
+from uuid import UUID
 from typing import Annotated
+from urllib.parse import urlencode
 
-import aiohttp
-from PIL import Image
 from fastapi import (
     Depends,
     FastAPI,
+    Header,
     Response,
     Path,
     Query,
 )
 from pydantic import BaseModel, AnyHttpUrl
 
-from verdandi.util.color import CW
-from verdandi.state import DepState
-from verdandi.configuration import ApiConfiguration
-from verdandi.util.logging import async_log_duration
-from verdandi.util.image import image_to_bytes
-from verdandi.middlewares import auth_middleware
+from verdandi.canvas import Canvas, CanvasFormat
+from verdandi.state import AppState, DepDevice, DepState
+from verdandi.middlewares import auth_default_middleware, auth_middleware
+from verdandi.registry import RegistryStats
+from verdandi.util.http import HttpPoolStats
+from verdandi.util.prometheus import Gauge, expose_all
 
 logger = logging.getLogger(__name__)
 
+REGISTRY_ENTRIES = Gauge(
+    "verdandi_registry_entries",
+    "Canvases pending retrieval in the response registry.",
+)
+
+REGISTRY_PENDING = Gauge(
+    "verdandi_registry_pending",
+    "Canvases of the response registry which are still being generated.",
+)
+
+REGISTRY_SIZE = Gauge(
+    "verdandi_registry_size_bytes",
+    "Size of canvases held in the response registry.",
+)
+
+IN_FLIGHT_GENERATIONS = Gauge(
+    "verdandi_in_flight_generations",
+    "Canvas generations in progress.",
+)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    state = AppState.get_shared_state()
+    await state.start()
+    yield
+    await state.stop()
+
 
 app = FastAPI(
+    lifespan=lifespan,
     openapi_tags=[
         {
             "name": "canvas",
             "description": "Generate a new canvas through an asynchronous API.",
         },
+        {
+            "name": "stats",
+            "description": "Monitor resources usage of the server.",
+        },
     ],
-    dependencies=[Depends(auth_middleware)],
 )
 
+# Canvas routes are authenticated against the requested device, other routes
+# against the default device
+DepAuthDevice = Depends(auth_middleware)
+DepAuthDefault = Depends(auth_default_middleware)
 
-class RedirectResponse(BaseModel):
+
+def server_timing(state: AppState, entry_id: UUID, start_time: float) -> str:
     """
-    Response specified by trmnl's redirect API.
-    See https://help.usetrmnl.com/en/articles/11035846-redirect-plugin
+    Time spent handling the request, along with the stages of the generation
+    of the canvas it serves.
     """
+    timings = [f"request;dur={(perf_counter() - start_time) * 1000:.1f}"]
 
-    filename: str
-    url: AnyHttpUrl
-    refresh_rate: int = 30 * 60
+    if (trace := state.traces.get(entry_id)) is not None and trace.spans:
+        timings.append(trace.server_timing())
 
+    return ", ".join(timings)
 
-@async_log_duration(logger, "Canvas generation")
-async def generate_canvas(configuration: ApiConfiguration, now: datetime) -> Response:
-    # Render all widgets concurently
-    connector = aiohttp.TCPConnector(ssl=False)  # TODO: is this a NixOS issue?
 
-    displayed_widgets = [
-        widget for widget in configuration.widgets if widget.is_displayed_at(now)
-    ]
+def get_canvas_format(
+    canvas_format: Annotated[
+        CanvasFormat | None,
+        Query(
+            alias="format",
+            title="Format of the canvas, negotiated from the Accept header if unset",
+        ),
+    ] = None,
+    accept: Annotated[str | None, Header()] = None,
+) -> CanvasFormat:
+    if canvas_format is not None:
+        return canvas_format
 
-    async with aiohttp.ClientSession(connector=connector) as http:
-        widget_imgs = await asyncio.gather(
-            *(widget.config.render(http) for widget in displayed_widgets)
-        )
+    return CanvasFormat.negotiate(accept)
 
-    # Paste rendered widgets to appropriate locations in a canvas
-    img = Image.new(mode="L", size=configuration.size, color=CW)
 
-    for widget, widget_img in zip(displayed_widgets, widget_imgs):
-        img.paste(widget_img, widget.position)
+DepCanvasFormat = Annotated[CanvasFormat, Depends(get_canvas_format)]
 
-    # Encode image to a buffer and respond
-    return Response(
-        content=image_to_bytes(img),
-        media_type="image/png",
-    )
+
+class RedirectResponse(BaseModel):
+    """
+    Response specified by trmnl's redirect API.
+    See https://help.usetrmnl.com/en/articles/11035846-redirect-plugin
+    """
+
+    filename: str
+    url: AnyHttpUrl
+    refresh_rate: int = 30 * 60
 
 
 @app.get(
     "/canvas/redirect/",
     tags=["canvas"],
+    dependencies=[DepAuthDevice],
     description="Start the generation of a new canvas.",
 )
 async def canvas_prepare(
     state: DepState,
+    device: DepDevice,
+    response: Response,
     wait: Annotated[
         bool,
         Query(title="Wait for the canvas to be ready before returning"),
     ] = False,
 ) -> RedirectResponse:
-    entry_id = uuid4()
+    start_time = perf_counter()
     now = datetime.now().astimezone()
 
-    task = asyncio.create_task(
-        generate_canvas(state.configuration, now),
-        name=f"generate-canvas-{entry_id}",
-    )
+    # Serve the pre-rendered canvas if there is one, or start a new generation
+    task: asyncio.Future[Canvas]
 
-    await state.set_response(entry_id, task)
+    if (prerendered := device.prerendered_at(now)) is not None:
+        entry_id = prerendered.entry_id
+        task = asyncio.get_running_loop().create_future()
+        task.set_result(prerendered.canvas)
+    else:
+        generation = state.generate(device.configuration, now)
+        entry_id = generation.entry_id
+        task = generation.task
+
+    state.set_response(entry_id, task, device.device_id)
 
     if wait:
-        await task
+        # The generation may be shared with other requests
+        await asyncio.shield(task)
 
     # Check next update time
-    next_update = min(
-        widget.config.next_update(now)
-        for widget in state.configuration.widgets
-        if widget.is_displayed_at(widget.config.next_update(now))
-    )
+    next_update = device.configuration.next_update(now)
 
     refresh_rate = max(
         60.0,
@@ -115,12 +166,22 @@ async def canvas_prepare(
     logger.info("Next update at %s", next_update.isoformat())
 
     url_str = os.path.join(
-        str(state.configuration.base_url),
+        str(device.configuration.base_url),
         f"canvas/redirect-get/{entry_id}/",
     )
 
-    if (secret := state.configuration.secret()) is not None:
-        url_str += f"?secret={secret}"
+    url_params = {}
+
+    if device.device_id is not None:
+        url_params["device"] = device.device_id
+
+    if (secret := device.configuration.secret()) is not None:
+        url_params["secret"] = secret
+
+    if url_params:
+        url_str += "?" + urlencode(url_params)
+
+    response.headers["Server-Timing"] = server_timing(state, entry_id, start_time)
 
     return RedirectResponse(
         filename=f"{entry_id}.png",
@@ -132,30 +193,93 @@ async def canvas_prepare(
 @app.get(
     "/canvas/redirect-get/{entry_id}/",
     tags=["canvas"],
+    dependencies=[DepAuthDevice],
     description="Wait to retreive the new canvas.",
 )
 async def canvas_retreive(
     state: DepState,
+    device: DepDevice,
     entry_id: Annotated[UUID, Path()],
+    canvas_format: DepCanvasFormat,
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
-    resp = await state.get_response(entry_id)
+    start_time = perf_counter()
+    canvas = await state.get_response(entry_id, device.device_id)
 
-    if resp is None:
-        return Response(
+    if canvas is None:
+        response = Response(
             "Could not find this entry ID",
             status_code=404,
         )
+    else:
+        response = await canvas.to_response(if_none_match, canvas_format)
 
-    return await state.get_response(entry_id)
+    response.headers["Server-Timing"] = server_timing(state, entry_id, start_time)
+    return response
 
 
 @app.get(
     "/canvas/direct/",
     tags=["canvas"],
+    dependencies=[DepAuthDevice],
     description="Generate and wait for a new canvas.",
 )
 async def canvas_direct(
     state: DepState,
+    device: DepDevice,
+    canvas_format: DepCanvasFormat,
+    if_none_match: Annotated[str | None, Header()] = None,
 ):
+    start_time = perf_counter()
     now = datetime.now().astimezone()
-    return await generate_canvas(state.configuration, now)
+    generation = state.generate(device.configuration, now)
+    canvas = await asyncio.shield(generation.task)
+
+    response = await canvas.to_response(if_none_match, canvas_format)
+    response.headers["Server-Timing"] = server_timing(
+        state, generation.entry_id, start_time
+    )
+
+    return response
+
+
+@app.get(
+    "/stats/http/",
+    tags=["stats"],
+    dependencies=[DepAuthDefault],
+    description="Usage of the shared HTTP connection pool.",
+)
+async def stats_http(state: DepState) -> HttpPoolStats | None:
+    if state.http is None:
+        return None
+
+    return HttpPoolStats.from_session(state.http)
+
+
+@app.get(
+    "/stats/registry/",
+    tags=["stats"],
+    dependencies=[DepAuthDefault],
+    description="Usage of the registry of canvases pending retrieval.",
+)
+async def stats_registry(state: DepState) -> RegistryStats:
+    return state.response_registry.stats()
+
+
+@app.get(
+    "/metrics",
+    tags=["stats"],
+    dependencies=[DepAuthDefault],
+    description="Metrics of the rendering pipeline, in Prometheus' text format.",
+    response_class=Response,
+)
+async def metrics(state: DepState) -> Response:
+    REGISTRY_ENTRIES.set(len(state.response_registry.entries))
+    REGISTRY_PENDING.set(len(state.response_registry.pending))
+    REGISTRY_SIZE.set(state.response_registry.size)
+    IN_FLIGHT_GENERATIONS.set(len(state.in_flight))
+
+    return Response(
+        content=expose_all(),
+        media_type="text/plain; version=0.0.4",
+    )
@@ -0,0 +1,401 @@
+import asyncio
+import contextvars
+import hashlib
+import logging
+from concurrent.futures import Executor
+from datetime import datetime, timedelta
+from enum import Enum
+from io import BytesIO
+from uuid import UUID
+
+import aiohttp
+from fastapi import Response, status
+from PIL import Image
+from pydantic import BaseModel, Field
+
+from verdandi.configuration import ApiConfiguration
+from verdandi.metric.abs_metric import Metric
+from verdandi.util.cache import LruStore
+from verdandi.util.color import CW
+from verdandi.util.common import executor
+from verdandi.util.image import (
+    image_to_bytes,
+    indexed_to_bitplanes,
+    indexed_to_bmp,
+)
+from verdandi.util.logging import async_log_duration
+from verdandi.util.prometheus import Histogram, async_observe_duration
+from verdandi.util.tracing import async_span, span
+from verdandi.widget.abs_widget import Widget
+
+logger = logging.getLogger(__name__)
+
+GENERATION_SECONDS = Histogram(
+    "verdandi_canvas_generation_seconds",
+    "Time spent generating canvases.",
+)
+
+PASTE_SECONDS = Histogram(
+    "verdandi_widget_paste_seconds",
+    "Time spent pasting widgets on canvases.",
+    labels=("widget",),
+)
+
+
+class CanvasFormat(Enum):
+    """
+    Formats a canvas can be served in.
+    """
+
+    PNG = "png"
+    BMP1 = "bmp1"
+    BMP2 = "bmp2"
+    RAW1 = "raw1"
+    RAW2 = "raw2"
+
+    @property
+    def media_type(self) -> str:
+        match self:
+            case CanvasFormat.PNG:
+                return "image/png"
+            case CanvasFormat.BMP1 | CanvasFormat.BMP2:
+                return "image/bmp"
+            case CanvasFormat.RAW1 | CanvasFormat.RAW2:
+                return "application/octet-stream"
+
+    @property
+    def bits(self) -> int:
+        return 1 if self in (CanvasFormat.BMP1, CanvasFormat.RAW1) else 2
+
+    @classmethod
+    def negotiate(cls, accept: str | None) -> "CanvasFormat":
+        """
+        Pick the format preferred by an Accept header, the bit depth of BMP and
+        raw formats can be specified with a `bits` parameter. PNG is used if no
+        other format is accepted.
+        """
+        if accept is None:
+            return cls.PNG
+
+        candidates = []
+
+        for item in accept.split(","):
+            media_type, *params = (part.strip() for part in item.split(";"))
+            args = dict(param.partition("=")[::2] for param in params)
+
+            try:
+                quality = float(args.get("q", 1.0))
+            except ValueError:
+                continue
+
+            match media_type.lower(), args.get("bits", "2"):
+                case "image/png" | "image/*" | "*/*", _:
+                    res = cls.PNG
+                case "image/bmp", "1":
+                    res = cls.BMP1
+                case "image/bmp", _:
+                    res = cls.BMP2
+                case "application/octet-stream", "1":
+                    res = cls.RAW1
+                case "application/octet-stream", _:
+                    res = cls.RAW2
+                case _:
+                    continue
+
+            if quality > 0:
+                candidates.append((quality, res))
+
+        # Sorting is stable, so the first of equally preferred formats is kept
+        candidates.sort(key=lambda candidate: -candidate[0])
+        return candidates[0][1] if candidates else cls.PNG
+
+
+# Canvases encoded in other formats than PNG, indexed by fingerprint and
+# format. Unlike PNGs, these are uncompressed (up to 96KB for 800x480 2-bit
+# canvases) so only a few of them are kept.
+_variants: LruStore[tuple[str, CanvasFormat], bytes] = LruStore(16)
+
+
+class Canvas(BaseModel):
+    """
+    An encoded canvas, addressed by the fingerprint of its content.
+    """
+
+    fingerprint: str
+    content: bytes
+
+    @property
+    def etag(self) -> str:
+        return self.etag_for(CanvasFormat.PNG)
+
+    def etag_for(self, canvas_format: CanvasFormat) -> str:
+        if canvas_format is CanvasFormat.PNG:
+            return f'"{self.fingerprint}"'
+
+        return f'"{self.fingerprint}-{canvas_format.value}"'
+
+    def matches(
+        self,
+        if_none_match: str | None,
+        canvas_format: CanvasFormat = CanvasFormat.PNG,
+    ) -> bool:
+        """
+        Check if the canvas matches the value of an If-None-Match header.
+        """
+        if if_none_match is None:
+            return False
+
+        return any(
+            tag.strip().removeprefix("W/") in ("*", self.etag_for(canvas_format))
+            for tag in if_none_match.split(",")
+        )
+
+    def encode(self, canvas_format: CanvasFormat) -> bytes:
+        """
+        Get the canvas in the given format.
+        """
+        if canvas_format is CanvasFormat.PNG:
+            return self.content
+
+        indexed = Image.open(BytesIO(self.content))
+
+        match canvas_format:
+            case CanvasFormat.BMP1 | CanvasFormat.BMP2:
+                content = indexed_to_bmp(indexed, canvas_format.bits)
+            case CanvasFormat.RAW1 | CanvasFormat.RAW2:
+                content = indexed_to_bitplanes(indexed, canvas_format.bits)
+
+        return content
+
+    async def to_response(
+        self,
+        if_none_match: str | None = None,
+        canvas_format: CanvasFormat = CanvasFormat.PNG,
+    ) -> Response:
+        headers = {"ETag": self.etag_for(canvas_format), "Vary": "Accept"}
+
+        if self.matches(if_none_match, canvas_format):
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        # The store is only accessed from the event loop, encoding happens in
+        # the executor.
+        key = (self.fingerprint, canvas_format)
+
+        if canvas_format is CanvasFormat.PNG:
+            content = self.content
+        elif (content := _variants.get(key)) is None:
+            content = await asyncio.get_running_loop().run_in_executor(
+                executor,
+                self.encode,
+                canvas_format,
+            )
+
+            _variants.set(key, content)
+
+        return Response(
+            content=content,
+            media_type=canvas_format.media_type,
+            headers=headers,
+        )
+
+
+class PrerenderedCanvas(BaseModel):
+    """
+    A canvas rendered ahead of time, to be displayed until the next update.
+    """
+
+    entry_id: UUID
+    time: datetime
+    next_update: datetime
+    canvas: Canvas
+
+    def is_valid_at(self, now: datetime) -> bool:
+        return self.time <= now < self.next_update
+
+
+class CanvasCache(BaseModel, arbitrary_types_allowed=True):
+    """
+    Keep the last generated canvases and widget tiles, indexed by their
+    fingerprint.
+    """
+
+    canvases: LruStore[str, Canvas] = Field(default_factory=lambda: LruStore(16))
+    tiles: LruStore[str, Image.Image] = Field(default_factory=lambda: LruStore(64))
+
+    # Last tile rendered for widgets along with its fingerprint, indexed by
+    # the widget's configuration, which is displayed if its metrics are late
+    latest_tiles: LruStore[str, tuple[str, Image.Image]] = Field(
+        default_factory=lambda: LruStore(64)
+    )
+
+
+# Renderings of late widgets, which are kept until they finish
+_late_renderings: set[asyncio.Task] = set()
+
+
+def _widget_key(widget: Widget) -> str:
+    return f"{widget.name}:{widget.model_dump_json()}"
+
+
+@async_log_duration(logger, "Canvas generation")
+@async_observe_duration(GENERATION_SECONDS)
+@async_span("generate")
+async def generate_canvas(
+    configuration: ApiConfiguration,
+    now: datetime,
+    http: aiohttp.ClientSession,
+    cache: CanvasCache | None = None,
+    render_pool: Executor | None = None,
+) -> Canvas:
+    displayed_widgets = configuration.displayed_widgets(now)
+
+    async def render_tile(
+        widget: Widget,
+        metrics: dict[str, Metric],
+        tile_fingerprint: str,
+    ) -> Image.Image:
+        if (
+            cache is not None
+            and (tile := cache.tiles.get(tile_fingerprint)) is not None
+        ):
+            return tile
+
+        tile = await widget.draw_metrics(now, metrics, render_pool)
+
+        if cache is not None:
+            cache.tiles.set(tile_fingerprint, tile)
+
+        return tile
+
+    async def render_late_tile(widget: Widget, load_task: asyncio.Task):
+        assert cache is not None
+
+        try:
+            metrics = await load_task
+            tile_fingerprint = widget.fingerprint(now, metrics)
+            tile = await render_tile(widget, metrics, tile_fingerprint)
+        except Exception:
+            logger.exception("Could not render late %s", type(widget).__name__)
+            return
+
+        cache.latest_tiles.set(_widget_key(widget), (tile_fingerprint, tile))
+
+    async def load_within_deadline(
+        widget: Widget,
+        deadline: timedelta | None,
+    ) -> dict[str, Metric] | None:
+        """
+        Load metrics of a widget, or return None if they are not loaded before
+        the deadline. Late metrics are still rendered in background so that
+        their tile is available for next canvases.
+        """
+        load_task = asyncio.create_task(widget.load_metrics(http))
+
+        if deadline is None:
+            return await load_task
+
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(load_task),
+                deadline.total_seconds(),
+            )
+        except TimeoutError:
+            logger.warning("Metrics of %s are late", type(widget).__name__)
+
+            if cache is None:
+                load_task.cancel()
+                return None
+
+            rendering = asyncio.create_task(render_late_tile(widget, load_task))
+            _late_renderings.add(rendering)
+            rendering.add_done_callback(_late_renderings.discard)
+            return None
+
+    # Fetch metrics of all widgets concurently
+    widget_metrics = await asyncio.gather(
+        *(
+            load_within_deadline(
+                widget.config,
+                widget.deadline or configuration.widget_deadline,
+            )
+            for widget in displayed_widgets
+        )
+    )
+
+    # Identify the canvas from everything its drawing depends on, late widgets
+    # are replaced by their latest tile or by a placeholder
+    tile_fingerprints = []
+    fallback_tiles: dict[int, Image.Image] = {}
+
+    for idx, (widget, metrics) in enumerate(zip(displayed_widgets, widget_metrics)):
+        if metrics is not None:
+            tile_fingerprints.append(widget.config.fingerprint(now, metrics))
+        elif (
+            cache is not None
+            and (latest := cache.latest_tiles.get(_widget_key(widget.config)))
+            is not None
+        ):
+            tile_fingerprints.append(latest[0])
+            fallback_tiles[idx] = latest[1]
+        else:
+            tile_fingerprints.append(f"placeholder:{widget.config.name}")
+            fallback_tiles[idx] = widget.config.placeholder()
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr(configuration.size).encode())
+    digest.update(configuration.encoding.model_dump_json().encode())
+
+    for widget, tile_fingerprint in zip(displayed_widgets, tile_fingerprints):
+        digest.update(repr(widget.position).encode())
+        digest.update(tile_fingerprint.encode())
+
+    fingerprint = digest.hexdigest()
+
+    if cache is not None and (canvas := cache.canvases.get(fingerprint)) is not None:
+        logger.info("Canvas %s found in cache", fingerprint)
+        return canvas
+
+    # Render widgets which are not already cached concurently
+    async def render_displayed_tile(idx: int) -> Image.Image:
+        if (tile := fallback_tiles.get(idx)) is not None:
+            return tile
+
+        widget = displayed_widgets[idx].config
+        metrics = widget_metrics[idx]
+        assert metrics is not None
+        tile = await render_tile(widget, metrics, tile_fingerprints[idx])
+
+        if cache is not None:
+            cache.latest_tiles.set(_widget_key(widget), (tile_fingerprints[idx], tile))
+
+        return tile
+
+    widget_imgs = await asyncio.gather(
+        *(render_displayed_tile(idx) for idx in range(len(displayed_widgets)))
+    )
+
+    # Paste rendered widgets to appropriate locations in a canvas
+    img = Image.new(mode="L", size=configuration.size, color=CW)
+
+    for widget, widget_img in zip(displayed_widgets, widget_imgs):
+        widget_name = type(widget.config).__name__
+
+        with PASTE_SECONDS.time(widget=widget_name), span("paste", widget=widget_name):
+            img.paste(widget_img, widget.position)
+
+    # Encode the canvas outside of the event loop, in the current trace
+    content = await asyncio.get_running_loop().run_in_executor(
+        executor,
+        contextvars.copy_context().run,
+        image_to_bytes,
+        img,
+        configuration.encoding.compress_level,
+        configuration.encoding.strategy,
+    )
+
+    canvas = Canvas(fingerprint=fingerprint, content=content)
+
+    if cache is not None:
+        cache.canvases.set(fingerprint, canvas)
+
+    return canvas
@@ -11,19 +11,26 @@ from verdandi.component.text import draw_text, Font
 def draw_curve(
     draw: ImageDraw,
     xy: tuple[int, int, int, int],
-    curve: Callable[[float], float],
+    curve: Callable[[float], float] | Sequence[float],
     shade_parts: list[tuple[float, AbcShade]] = [(1.0, ShadeUniform(CB))],
     y_scale: Sequence[tuple[str, float, AbcShade]] = [],
     y_origin: float = 0.0,
 ):
+    """
+    Draw a curve given as a function of x in [0, 1], or as the values for each
+    column of pixels.
+    """
     assert len(shade_parts) > 0
     (x_min, x_max), (y_min, y_max) = xy_to_bounds(xy)
     y_origin_coord = y_min + int((y_max - y_min) * (1.0 - y_origin))
 
-    min_height = [
-        y_min + int((y_max - y_min) * (1.0 - curve((x - x_min) / (x_max - x_min))))
-        for x in range(x_min, x_max + 1)
-    ]
+    if callable(curve):
+        values = [curve((x - x_min) / (x_max - x_min)) for x in range(x_min, x_max + 1)]
+    else:
+        assert len(curve) == x_max - x_min + 1
+        values = curve
+
+    min_height = [y_min + int((y_max - y_min) * (1.0 - value)) for value in values]
 
     # Draw each section with its own density
     prev_cursor = 0.0
@@ -27,6 +27,14 @@ def list_icons() -> list[str]:
     return result
 
 
+def preload_icons():
+    """
+    Load all icons in memory.
+    """
+    for icon_name in list_icons():
+        _load_icon(icon_name)
+
+
 def icon_size(icon_name: str) -> tuple[int, int]:
     icon = _load_icon(icon_name)
     return icon.size
@@ -51,6 +51,14 @@ class Font(Enum):
         )
 
 
+def preload_fonts():
+    """
+    Load all fonts in memory.
+    """
+    for font in Font:
+        _ = font.font
+
+
 def draw_text(
     draw: ImageDraw,
     xy: tuple[int, int],
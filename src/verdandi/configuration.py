@@ -1,13 +1,17 @@
+import hashlib
 import logging
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import cached_property
 from typing import Annotated, Union, Literal
 from pathlib import Path
 
+import aiohttp
 import yaml
-from pydantic import BaseModel, Field, AnyHttpUrl
-from simpleeval import simple_eval
+from pydantic import BaseModel, Field, AnyHttpUrl, PrivateAttr
 
+from verdandi.util.image import CompressionStrategy
+from verdandi.util.schedule import DisplaySchedule, WhenPredicate
 from verdandi.widget import ALL_WIDGETS
 
 
@@ -19,30 +23,67 @@ def widget_config_for(widget_type) -> type[BaseModel]:
         name: Literal[widget_type.name]  # ty: ignore[invalid-type-form]
         position: tuple[int, int]
         when: str = "True"
+        # Maximum time the widget's metrics are waited for, overrides the
+        # deadline of the configuration
+        deadline: timedelta | None = None
         config: widget_type
+        _predicate: WhenPredicate = PrivateAttr()
+
+        def model_post_init(self, context):
+            self._predicate = WhenPredicate(self.when)
+
+        @property
+        def predicate(self) -> WhenPredicate:
+            return self._predicate
 
         def is_displayed_at(self, now: datetime) -> bool:
-            res = simple_eval(
-                self.when,
-                names={
-                    "now": {
-                        "hour": now.hour,
-                        "minute": now.minute,
-                        "weekday": now.weekday(),
-                        "month": now.month,
-                        "day": now.day,
-                    }
-                },
-            )
-
-            if not isinstance(res, bool):
-                logger.warning("`when` does not evaluate to bool for %s", self.name)
-
-            return bool(res)
+            return self._predicate(now)
 
     return WidgetConfiguration
 
 
+class HttpConfiguration(BaseModel):
+    # Maximum number of simultaneous connections, overall and to a single host
+    limit: int = 100
+    limit_per_host: int = 8
+    # Duration resolved DNS entries are kept for
+    dns_cache_ttl: timedelta = timedelta(minutes=5)
+    # Duration idle connections are kept open for reuse
+    keepalive_timeout: timedelta = timedelta(seconds=30)
+
+    def create_session(self) -> aiohttp.ClientSession:
+        """
+        Create a new HTTP session using a connection pool with these settings.
+        This must be called from a running event loop.
+        """
+        connector = aiohttp.TCPConnector(
+            ssl=False,  # TODO: is this a NixOS issue?
+            limit=self.limit,
+            limit_per_host=self.limit_per_host,
+            resolver=aiohttp.AsyncResolver(),
+            use_dns_cache=True,
+            ttl_dns_cache=int(self.dns_cache_ttl.total_seconds()),
+            keepalive_timeout=self.keepalive_timeout.total_seconds(),
+        )
+
+        return aiohttp.ClientSession(connector=connector)
+
+
+class RegistryConfiguration(BaseModel):
+    # Duration a canvas can be retrieved for after it was requested
+    max_duration: timedelta = timedelta(hours=3)
+    # Maximum number of retrievable canvases, the oldest ones are evicted first
+    max_entries: int = 1024
+    # Maximum total size of retrievable canvases, in bytes
+    max_size: int = 32 * 1024 * 1024
+
+
+class EncodingConfiguration(BaseModel):
+    # zlib compression level of canvases, from 0 (fastest) to 9 (smallest)
+    compress_level: int = Field(default=6, ge=0, le=9)
+    strategy: CompressionStrategy = CompressionStrategy.DEFAULT
+
+
 _all_widget_configs: tuple[type[BaseModel], ...] = tuple(
     widget_config_for(w) for w in ALL_WIDGETS
 )
@@ -53,6 +94,25 @@ class ApiConfiguration(BaseModel):
     size: tuple[int, int]
     widgets: list[Annotated[Union[*_all_widget_configs], Field(discriminator="name")]]  # ty:ignore[invalid-type-form]
     use_secret: bool = False
+    http: HttpConfiguration = Field(default_factory=HttpConfiguration)
+    # Number of worker processes widgets are drawn in, they are drawn in
+    # threads of the main process if unset.
+    render_processes: int | None = None
+    registry: RegistryConfiguration = Field(default_factory=RegistryConfiguration)
+    encoding: EncodingConfiguration = Field(default_factory=EncodingConfiguration)
+
+    # How long before the next expected update the canvas is rendered in
+    # background, pre-rendering is disabled if unset.
+    prerender_advance: timedelta | None = None
+
+    # Maximum time metrics of each widget are waited for, late widgets are
+    # displayed from their latest tile (or as a placeholder) and updated for
+    # next canvases. Metrics are waited for indefinitely if unset.
+    widget_deadline: timedelta | None = None
+
+    # File that traces of canvas generations are appended to, in OTLP/JSON
+    # format, traces are not exported if unset.
+    trace_file: Path | None = None
 
     @classmethod
     def load(cls, path: str | Path | None = None) -> "ApiConfiguration":
@@ -64,6 +124,39 @@ class ApiConfiguration(BaseModel):
 
         return cls(**data)
 
+    @cached_property
+    def fingerprint(self) -> str:
+        """
+        Digest of the parts of the configuration the canvas depends on.
+        """
+        return hashlib.blake2b(
+            self.model_dump_json(include={"size", "widgets", "encoding"}).encode(),
+            digest_size=16,
+        ).hexdigest()
+
+    @cached_property
+    def display_schedule(self) -> DisplaySchedule:
+        return DisplaySchedule(self.widgets)
+
+    def displayed_widgets(self, now: datetime) -> list:
+        return self.display_schedule.displayed_at(now)
+
+    def next_update(self, now: datetime) -> datetime:
+        """
+        Return the next time any displayed widget wishes to be updated at, or
+        the next time a widget appears or disappears.
+        """
+        updates = [
+            update
+            for widget in self.widgets
+            if widget.is_displayed_at(update := widget.config.next_update(now))
+        ]
+
+        if (change := self.display_schedule.next_change(now)) is not None:
+            updates.append(change)
+
+        return min(updates)
+
     def secret(self) -> str | None:
         if not self.use_secret:
             return None
@@ -1,18 +1,100 @@
+import hashlib
 from abc import ABC, abstractmethod
-from typing import ClassVar, Generic, TypeVar
+from datetime import datetime
+from typing import Any, ClassVar, Generic, Self, TypeVar
 
 import aiohttp
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
+
+from verdandi.util.cache import LruStore
 
 M = TypeVar("M")
 
 
 class MetricConfig(ABC, BaseModel, Generic[M], frozen=True):
+    # Configurations are used as cache keys, their hash is computed once
+    _hash: int | None = PrivateAttr(None)
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            self._hash = hash((type(self), *self.__dict__.values()))
+
+        return self._hash
+
+    def __eq__(self, other: object) -> bool:
+        # Unlike pydantic's, ignore private attributes
+        if self is other:
+            return True
+
+        if type(self) is not type(other):
+            return NotImplemented
+
+        return self.__dict__ == other.__dict__
+
+    def intern(self) -> Self:
+        """
+        Get the instance shared by all configurations equal to this one, which
+        are then compared by identity when looking up caches.
+        """
+        if (res := _interned_configs.get(self)) is None:
+            res = self
+            _interned_configs.set(self, self)
+
+        return res
+
     @classmethod
     @abstractmethod
     async def load(self, http: aiohttp.ClientSession) -> M:
         raise NotImplementedError
 
 
+# Configurations of the widgets of loaded devices, evicting one only stops
+# sharing its caches with the configurations equal to it.
+_interned_configs: LruStore[MetricConfig, MetricConfig] = LruStore(1024)
+
+
 class Metric(BaseModel):
     name: ClassVar[str]
+    _fingerprints: dict[frozenset[str] | None, str] = PrivateAttr(default_factory=dict)
+
+    # Time the value was fetched at, it is kept by copies
+    _loaded_at: datetime = PrivateAttr(default_factory=datetime.now)
+
+    # Time the value was loaded at if it is served instead of a fresh value
+    # which could not be loaded
+    _stale_since: datetime | None = PrivateAttr(None)
+
+    @property
+    def loaded_at(self) -> datetime:
+        return self._loaded_at
+
+    @property
+    def stale_since(self) -> datetime | None:
+        return self._stale_since
+
+    def as_stale(self, since: datetime) -> Self:
+        res = self.model_copy()
+        res._stale_since = since
+        return res
+
+    def fingerprint(self, fields: frozenset[str] | None = None) -> str:
+        """
+        Digest of the metric's content, restricted to some fields if
+        specified. It is computed once per metric value as these are shared
+        through cache.
+        """
+        if (res := self._fingerprints.get(fields)) is None:
+            res = hashlib.blake2b(
+                self.model_dump_json(include=fields).encode(),
+                digest_size=16,
+            ).hexdigest()
+
+            self._fingerprints[fields] = res
+
+        return res
+
+    def model_copy(self, *, update: dict[str, Any] | None = None, deep=False) -> Self:
+        # Cached fingerprints would be outdated by the update
+        copied = super().model_copy(update=update, deep=deep)
+        copied._fingerprints = {}
+        return copied
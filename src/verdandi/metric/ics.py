@@ -1,21 +1,30 @@
 import asyncio
+import bisect
 import enum
+import hashlib
+import itertools
 import logging
-from datetime import date, datetime, timedelta, time
-from typing import ClassVar
+from datetime import UTC, date, datetime, timedelta, time
+from typing import ClassVar, Iterator, Self
 from zoneinfo import ZoneInfo
 
 import aiohttp
 from icalevents.icalevents import events, Event
-from pydantic import AnyHttpUrl, BaseModel, AwareDatetime, Field
+from pydantic import AnyHttpUrl, BaseModel, AwareDatetime, Field, PrivateAttr
 
 from verdandi.metric.abs_metric import Metric, MetricConfig
-from verdandi.util.cache import async_time_cache
+from verdandi.util.cache import LruStore, async_time_cache
 from verdandi.util.logging import async_log_duration
 from verdandi.util.common import executor
+from verdandi.util.http import conditional_get, parse_raw
+from verdandi.util.tracing import span
 
 logger = logging.getLogger(__name__)
 
+# Events parsed from calendars, indexed by the digest of the calendar's content
+# and the period events are expanded over
+_parsed_calendars: LruStore[tuple[str, datetime, datetime], list[Event]] = LruStore(32)
+
 
 @enum.unique
 class Label(enum.Enum):
@@ -119,7 +128,10 @@ class ICSEvent(BaseModel):
         fully spans multiple periods, the earliest one is returned.
         """
 
-        def period_ratio(period: DayPeriod) -> float:
+        res = DayPeriod.MORNING
+        best_ratio = None
+
+        for period in DayPeriod:
             # Period bounds on day
             p_start = datetime.combine(
                 day,
@@ -133,17 +145,27 @@ class ICSEvent(BaseModel):
                 tzinfo=self.date_end.tzinfo,
             )
 
-            # Event bounds
+            # Share of the period covered by the event
             e_start = max(p_start, self.date_start)
             e_end = min(p_end, self.date_end)
+            ratio = (e_end - e_start) / (p_end - p_start)
+
+            if best_ratio is None or ratio > best_ratio:
+                res = period
+                best_ratio = ratio
+
+        return res
 
-            return (
-                -(e_end - e_start).total_seconds() / (p_end - p_start).total_seconds()
-            )
 
-        period_ratios = [(period_ratio(period), period) for period in list(DayPeriod)]
-        period_ratios.sort(key=lambda x: x[0])
-        return period_ratios[0][1]
+class DayOccupancy(BaseModel):
+    """
+    Events of a day, split between events covering the whole day and events
+    of the periods of the day.
+    """
+
+    events: list[ICSEvent]
+    full_day: list[ICSEvent]
+    periods: list[tuple[DayPeriod, ICSEvent]]
 
 
 class ICSMetric(Metric):
@@ -152,6 +174,51 @@ class ICSMetric(Metric):
     upcoming: list[ICSEvent]
     showcase: list[ICSEvent]
 
+    # Events sorted by start, along with their starts and the maximum end of
+    # all events up to each of them (which is sorted as well)
+    _sorted_events: list[ICSEvent] = PrivateAttr()
+    _starts: list[datetime] = PrivateAttr()
+    _max_ends: list[datetime] = PrivateAttr()
+
+    # Events indexed by the days they occur on, and occupancies of days which
+    # were already queried
+    _days: dict[date, list[ICSEvent]] = PrivateAttr()
+    _occupancies: dict[date, DayOccupancy] = PrivateAttr()
+
+    def model_post_init(self, context):
+        self._sorted_events = sorted(self.all_events, key=lambda e: e.date_start)
+        self._starts = [event.date_start for event in self._sorted_events]
+        self._max_ends = []
+        self._days = {}
+        self._occupancies = {}
+
+        for event in self._sorted_events:
+            max_end = event.date_end
+
+            if self._max_ends and self._max_ends[-1] > max_end:
+                max_end = self._max_ends[-1]
+
+            self._max_ends.append(max_end)
+
+            # An event occurs on each day from its start to its end, except on
+            # the day it ends if it ends at midnight
+            last_day = event.date_end.date()
+
+            if event.date_end.time() == time(0, 0):
+                last_day -= timedelta(days=1)
+
+            day = event.date_start.date()
+
+            while day <= last_day:
+                self._days.setdefault(day, []).append(event)
+                day += timedelta(days=1)
+
+    def model_copy(self, *args, **kwargs) -> Self:
+        # Indexes must be rebuilt if events are updated
+        res = super().model_copy(*args, **kwargs)
+        res.model_post_init(None)
+        return res
+
     def next_showcase_event(self, now: datetime) -> ICSEvent | None:
         return next(
             (event for event in self.showcase if (event.date_end - now).days >= 0),
@@ -159,59 +226,165 @@ class ICSMetric(Metric):
         )
 
     def on_date(self, day: date) -> list[ICSEvent]:
-        return [
-            event
-            for event in self.all_events
-            if (
-                event.date_start.date() <= day
-                and (
-                    event.date_end
-                    > datetime.combine(day, time(0, 0), tzinfo=event.date_end.tzinfo)
-                )
-            )
-        ]
+        # The index is shared by all queries, a copy is handed out
+        return list(self._days.get(day, ()))
 
+    def between(self, start: datetime, end: datetime) -> list[ICSEvent]:
+        """
+        List events overlapping the given period, sorted by start.
+        """
+        lo = bisect.bisect_right(self._max_ends, start)
+        hi = bisect.bisect_left(self._starts, end)
 
-class ICSConfig(MetricConfig[ICSMetric], frozen=True):
-    timezone: str = Field(description="your local timezone")
-    calendars: tuple[ICSCalendar, ...]
+        return [event for event in self._sorted_events[lo:hi] if event.date_end > start]
+
+    def iter_days(self, start: datetime) -> Iterator[tuple[date, list[ICSEvent]]]:
+        """
+        Lazily iterate over the days on which events that are not over at
+        `start` occur, in order. Events still ongoing at `start` are listed
+        from their first day. Events of each day are sorted by start, an event
+        ending at midnight does not occur on its last day.
+        """
 
-    @staticmethod
-    async def _load_from_url(
-        http: aiohttp.ClientSession,
-        cal: ICSCalendar,
-        now: datetime,
-    ) -> list[Event]:
-        loop = asyncio.get_event_loop()
+        def last_day(event: ICSEvent) -> date:
+            if event.date_start < event.date_end:
+                return (event.date_end - timedelta(seconds=1)).date()
 
-        async with http.get(str(cal.url)) as resp:
-            data = await resp.read()
+            return event.date_start.date()
 
-        return await loop.run_in_executor(
+        # Events started before `start` which are not over yet, followed by
+        # all events starting after it
+        idx = bisect.bisect_right(self._starts, start)
+        lo = bisect.bisect_left(self._max_ends, start)
+        ongoing = [e for e in self._sorted_events[lo:idx] if e.date_end >= start]
+        pending = itertools.chain(
+            ongoing, itertools.islice(self._sorted_events, idx, None)
+        )
+        upcoming = next(pending, None)
+        active: list[ICSEvent] = []
+        day = start.date()
+
+        if ongoing:
+            day = min(day, ongoing[0].date_start.date())
+
+        while active or upcoming is not None:
+            # Skip days without any event
+            if not active:
+                assert upcoming is not None
+                day = max(day, upcoming.date_start.date())
+
+            while upcoming is not None and upcoming.date_start.date() <= day:
+                active.append(upcoming)
+                upcoming = next(pending, None)
+
+            if events := [event for event in active if last_day(event) >= day]:
+                yield day, events
+
+            active = [event for event in events if last_day(event) > day]
+            day += timedelta(days=1)
+
+    def occupancy(self, day: date) -> DayOccupancy:
+        if (res := self._occupancies.get(day)) is not None:
+            return res
+
+        events = self.on_date(day)
+        full_day = [event for event in events if event.is_full_day(day)]
+
+        res = DayOccupancy(
+            events=events,
+            full_day=full_day,
+            periods=[
+                (event.day_period(day), event)
+                for event in events
+                if not event.is_full_day(day)
+            ],
+        )
+
+        self._occupancies[day] = res
+        return res
+
+
+def _parse_window(now: datetime) -> tuple[datetime, datetime]:
+    """
+    Period calendars are expanded over at `now`, which is wide enough for any
+    timezone and aligned on days.
+    """
+    today = now.astimezone(UTC).date()
+    start = datetime(today.year, 1, 1, tzinfo=UTC) - timedelta(days=1)
+    end = datetime.combine(today, time(), UTC) + timedelta(days=2 * 365 + 1)
+    return start, end
+
+
+# Calendars are cached by URL only: once the period they are expanded over
+# rolls over, the next background refresh expands them over the new one while
+# the previous period, which still covers the next two years, is served.
+@async_time_cache(
+    timedelta(hours=3),
+    refresh_ahead=0.8,
+    max_staleness=timedelta(hours=1),
+)
+async def load_calendar_events(
+    http: aiohttp.ClientSession,
+    url: str,
+) -> list[Event]:
+    """
+    Fetch a calendar and expand its events over the current period. Times of
+    events which are not bound to a timezone are kept as is.
+    """
+    start, end = _parse_window(datetime.now(UTC))
+
+    # The raw content is kept to expand it over a new period without
+    # downloading it again
+    data = await conditional_get(http, url, parse_raw)
+
+    # Calendars are often downloaded again with the same content
+    key = (hashlib.blake2b(data, digest_size=16).hexdigest(), start, end)
+
+    if (parsed := _parsed_calendars.get(key)) is not None:
+        return parsed
+
+    with span("parse", calendar=url):
+        parsed = await asyncio.get_running_loop().run_in_executor(
             executor,
             lambda: events(
                 string_content=data,
-                start=datetime(now.year, 1, 1, tzinfo=now.tzinfo),
-                end=now + timedelta(days=2 * 365),
+                start=start,
+                end=end,
                 strict=True,
             ),
         )
 
-    @async_time_cache(timedelta(hours=3))
+    _parsed_calendars.set(key, parsed)
+    return parsed
+
+
+class ICSConfig(MetricConfig[ICSMetric], frozen=True):
+    timezone: str = Field(description="your local timezone")
+    calendars: tuple[ICSCalendar, ...]
+
+    # Calendars are fetched and parsed once for all configurations including
+    # them, only the merge of their events is done per configuration. It is
+    # refreshed in background as well, out of the way of requests.
+    @async_time_cache(
+        timedelta(hours=3),
+        refresh_ahead=0.8,
+        max_staleness=timedelta(hours=1),
+    )
     @async_log_duration(logger, "Loading all calendars")
     async def load(self, http: aiohttp.ClientSession) -> ICSMetric:
         tz = ZoneInfo(self.timezone)
         now = datetime.now(tz)
+        year_start = datetime(now.year, 1, 1, tzinfo=tz)
 
         parsed_calendars = await asyncio.gather(
-            *(self._load_from_url(http, cal, now) for cal in self.calendars)
+            *(load_calendar_events(http, str(cal.url)) for cal in self.calendars)
         )
 
         all_events = [
             event
             for calendar, lib_events in zip(self.calendars, parsed_calendars)
             for event in map(lambda e: ICSEvent.from_lib(e, calendar, tz), lib_events)
-            if Label.IGNORE not in event.labels
+            if Label.IGNORE not in event.labels and event.date_end > year_start
         ]
 
         all_events.sort(key=lambda e: e.date_start)
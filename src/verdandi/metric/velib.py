@@ -8,6 +8,7 @@ import aiohttp
 from verdandi.metric.abs_metric import Metric, MetricConfig
 from verdandi.util.logging import async_log_duration
 from verdandi.util.cache import async_time_cache
+from verdandi.util.http import conditional_get, parse_json
 
 
 logger = logging.getLogger(__name__)
@@ -30,13 +31,11 @@ class VelibConfig(MetricConfig[VelibMetric], frozen=True):
     station_id: int
 
     @classmethod
-    @async_time_cache(timedelta(hours=1))
+    @async_time_cache(timedelta(hours=1), max_staleness=timedelta(days=1))
     @async_log_duration(logger, "Fetch velib informations")
     async def get_stations_information(cls, http: aiohttp.ClientSession) -> dict:
         url = cls.API_URL + "/station_information.json"
-
-        async with http.get(url) as resp:
-            data = await resp.json()
+        data = await conditional_get(http, url, parse_json)
 
         return data["data"]["stations"]
 
@@ -45,9 +44,7 @@ class VelibConfig(MetricConfig[VelibMetric], frozen=True):
     @async_log_duration(logger, "Fetch velib statuses")
     async def get_stations_status(cls, http: aiohttp.ClientSession) -> dict:
         url = cls.API_URL + "/station_status.json"
-
-        async with http.get(url) as resp:
-            data = await resp.json()
+        data = await conditional_get(http, url, parse_json)
 
         return data["data"]["stations"]
 
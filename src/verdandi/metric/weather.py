@@ -1,15 +1,19 @@
+import asyncio
+import bisect
 import logging
 from datetime import datetime, time, date, timedelta
 from enum import Enum
 from functools import cache
-from typing import ClassVar
+from typing import Any, ClassVar, Self, overload
 
 import aiohttp
-from pydantic import BaseModel, conlist, Field
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
 
 from verdandi.metric.abs_metric import Metric, MetricConfig
 from verdandi.util.logging import async_log_duration
 from verdandi.util.cache import async_time_cache
+from verdandi.util.http import conditional_get, parse_json
+from verdandi.util.session import background_session
 
 
 logger = logging.getLogger(__name__)
@@ -72,6 +76,216 @@ class DailyData(BaseModel):
     temperature_max: float
 
 
+# Origin of timestamps of local times, which are not bound to a timezone
+_LOCAL_EPOCH = datetime(1970, 1, 1)
+
+
+def _local_timestamp(dt: datetime) -> float:
+    return (dt - _LOCAL_EPOCH).total_seconds()
+
+
+class RangeBounds:
+    """
+    Sparse tables answering min and max queries over any range of a series in
+    constant time.
+    """
+
+    def __init__(self, values: list[float]):
+        self.mins = [values]
+        self.maxs = [values]
+        width = 1
+
+        while 2 * width <= len(values):
+            prev_mins, prev_maxs = self.mins[-1], self.maxs[-1]
+            count = len(values) - 2 * width + 1
+
+            self.mins.append(
+                [min(prev_mins[i], prev_mins[i + width]) for i in range(count)]
+            )
+
+            self.maxs.append(
+                [max(prev_maxs[i], prev_maxs[i + width]) for i in range(count)]
+            )
+
+            width *= 2
+
+    def bounds(self, start: int, end: int) -> tuple[float, float]:
+        """
+        Return min and max of values with index in [start, end).
+        """
+        assert start < end
+        level = (end - start).bit_length() - 1
+        end -= 1 << level
+
+        return (
+            min(self.mins[level][start], self.mins[level][end]),
+            max(self.maxs[level][start], self.maxs[level][end]),
+        )
+
+
+class HourlySeries(BaseModel):
+    """
+    Hourly forecast stored column-wise, sorted by time.
+    """
+
+    time: list[datetime]
+    temperature: list[float]
+    weather_code: list[WeatherCode]
+    rain_probability: list[float]
+
+    _timestamps: list[float] = PrivateAttr()
+    _temperature_bounds: RangeBounds = PrivateAttr()
+
+    @model_validator(mode="after")
+    def check_lengths(self) -> Self:
+        lengths = {
+            len(self.time),
+            len(self.temperature),
+            len(self.weather_code),
+            len(self.rain_probability),
+        }
+
+        if len(lengths) != 1 or 0 in lengths:
+            raise ValueError("hourly forecast columns must have the same length")
+
+        return self
+
+    def model_post_init(self, context):
+        self._timestamps = [_local_timestamp(dt) for dt in self.time]
+        self._temperature_bounds = RangeBounds(self.temperature)
+
+    def model_copy(self, *args, **kwargs) -> Self:
+        # Indexes must be rebuilt if columns are updated
+        res = super().model_copy(*args, **kwargs)
+        res.model_post_init(None)
+        return res
+
+    def __len__(self) -> int:
+        return len(self.time)
+
+    def __getitem__(self, idx: int) -> HourlyData:
+        return HourlyData(
+            time=self.time[idx],
+            temperature=self.temperature[idx],
+            weather_code=self.weather_code[idx],
+            rain_probability=self.rain_probability[idx],
+        )
+
+    def _interpolate(self, idx: int, timestamp: float) -> float:
+        """
+        Interpolate temperature at a timestamp, given the index of the first
+        point after it.
+        """
+        if idx == 0:
+            return self.temperature[0]
+
+        if idx == len(self._timestamps):
+            return self.temperature[-1]
+
+        prev_time, next_time = self._timestamps[idx - 1], self._timestamps[idx]
+        progress = (timestamp - prev_time) / (next_time - prev_time)
+
+        return (
+            self.temperature[idx - 1] * (1.0 - progress)
+            + self.temperature[idx] * progress
+        )
+
+    def interpolate_temperature_at(self, dt: datetime) -> float:
+        timestamp = _local_timestamp(dt)
+        return self._interpolate(
+            bisect.bisect_right(self._timestamps, timestamp), timestamp
+        )
+
+    def interpolate_temperatures(
+        self,
+        dt_start: datetime,
+        dt_end: datetime,
+        count: int,
+    ) -> list[float]:
+        """
+        Interpolate temperatures at `count` evenly spaced times from `dt_start`
+        to `dt_end`, in a single pass over the series.
+        """
+        start, end = _local_timestamp(dt_start), _local_timestamp(dt_end)
+        assert start <= end
+        step = (end - start) / (count - 1) if count > 1 else 0.0
+        idx = bisect.bisect_right(self._timestamps, start)
+        res = []
+
+        for i in range(count):
+            timestamp = start + i * step
+
+            while idx < len(self._timestamps) and self._timestamps[idx] <= timestamp:
+                idx += 1
+
+            res.append(self._interpolate(idx, timestamp))
+
+        return res
+
+    def temperature_bounds(
+        self,
+        dt_min: datetime,
+        dt_max: datetime,
+    ) -> tuple[float, float]:
+        temperatures = [
+            self.interpolate_temperature_at(dt_min),
+            self.interpolate_temperature_at(dt_max),
+        ]
+
+        start = bisect.bisect_left(self._timestamps, _local_timestamp(dt_min))
+        end = bisect.bisect_right(self._timestamps, _local_timestamp(dt_max))
+
+        if start < end:
+            temperatures.extend(self._temperature_bounds.bounds(start, end))
+
+        return min(temperatures), max(temperatures)
+
+
+class DailySeries(BaseModel):
+    """
+    Daily forecast stored column-wise, sorted by date.
+    """
+
+    date: list[date]
+    weather_code: list[WeatherCode]
+    temperature_min: list[float]
+    temperature_max: list[float]
+
+    @model_validator(mode="after")
+    def check_lengths(self) -> Self:
+        lengths = {
+            len(self.date),
+            len(self.weather_code),
+            len(self.temperature_min),
+            len(self.temperature_max),
+        }
+
+        if len(lengths) != 1 or 0 in lengths:
+            raise ValueError("daily forecast columns must have the same length")
+
+        return self
+
+    def __len__(self) -> int:
+        return len(self.date)
+
+    @overload
+    def __getitem__(self, idx: int) -> DailyData: ...
+
+    @overload
+    def __getitem__(self, idx: slice) -> list[DailyData]: ...
+
+    def __getitem__(self, idx: int | slice) -> DailyData | list[DailyData]:
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        return DailyData(
+            date=self.date[idx],
+            weather_code=self.weather_code[idx],
+            temperature_min=self.temperature_min[idx],
+            temperature_max=self.temperature_max[idx],
+        )
+
+
 class WeatherMetric(Metric):
     name = "weather"
     time: datetime
@@ -80,50 +294,112 @@ class WeatherMetric(Metric):
     weather_code: WeatherCode
     sunrise: time
     sunset: time
-    daily: conlist(DailyData, min_length=7, max_length=7)  # ty:ignore[invalid-type-form]
-    hourly: conlist(HourlyData, min_length=7 * 24, max_length=7 * 24)  # ty:ignore[invalid-type-form]
+    daily: DailySeries
+    hourly: HourlySeries | None
 
     def interpolate_temperature_at(self, dt: datetime) -> float:
         """
         Compute interpolated temperature at a given time.
         """
-        first_point = next((pt for pt in self.hourly[::-1] if pt.time <= dt), None)
-        last_point = next((pt for pt in self.hourly if pt.time > dt), None)
+        assert self.hourly is not None
+        return self.hourly.interpolate_temperature_at(dt)
 
-        if first_point is None:
-            assert last_point is not None
-            return last_point.temperature
+    def temerature_bounds(
+        self,
+        dt_min: datetime,
+        dt_max: datetime,
+    ) -> tuple[float, float]:
+        assert self.hourly is not None
+        return self.hourly.temperature_bounds(dt_min, dt_max)
 
-        if last_point is None:
-            assert first_point is not None
-            return first_point.temperature
 
-        interval = (last_point.time - first_point.time).total_seconds()
-        progress = (dt - first_point.time).total_seconds() / interval
+class WeatherRequirements(BaseModel, frozen=True):
+    """
+    Days of forecast a widget reads, starting from today. Daily forecast of
+    today is always fetched as it holds sun events.
+    """
 
-        return (
-            first_point.temperature * (1.0 - progress)
-            + last_point.temperature * progress
+    daily_days: int = Field(default=7, ge=1, le=16)
+    hourly_days: int = Field(default=7, ge=0, le=16)
+
+    @property
+    def forecast_days(self) -> int:
+        return max(self.daily_days, self.hourly_days)
+
+    def merge(self, other: "WeatherRequirements") -> "WeatherRequirements":
+        return WeatherRequirements(
+            daily_days=max(self.daily_days, other.daily_days),
+            hourly_days=max(self.hourly_days, other.hourly_days),
         )
 
-    def temerature_bounds(
+
+class WeatherLocation(BaseModel, frozen=True):
+    """
+    A location forecasts are fetched for, with coordinates snapped to a grid.
+    """
+
+    lat: float
+    lon: float
+    timezone: str
+
+    @async_time_cache(
+        timedelta(minutes=5),
+        refresh_ahead=0.8,
+        max_staleness=timedelta(minutes=15),
+    )
+    @async_log_duration(logger, "Fetch weather data")
+    async def load(
         self,
-        dt_min: datetime,
-        dt_max: datetime,
-    ) -> tuple[float, float]:
-        temperatures = [
-            pt.temperature for pt in self.hourly if dt_min <= pt.time <= dt_max
-        ]
+        http: aiohttp.ClientSession,
+        requirements: WeatherRequirements,
+    ) -> WeatherMetric:
+        data = await weather_batcher.fetch(http, self, requirements)
+
+        # The forecast may have been fetched for more demanding widgets
+        days = slice(requirements.daily_days)
+        hours = slice(24 * requirements.hourly_days)
+
+        daily = DailySeries(
+            date=list(map(date.fromisoformat, data["daily"]["time"][days])),
+            weather_code=list(
+                map(WeatherCode.from_wmo_mapping, data["daily"]["weather_code"][days])
+            ),
+            temperature_min=data["daily"]["temperature_2m_min"][days],
+            temperature_max=data["daily"]["temperature_2m_max"][days],
+        )
 
-        temperatures.append(self.interpolate_temperature_at(dt_min))
-        temperatures.append(self.interpolate_temperature_at(dt_max))
-        return min(temperatures), max(temperatures)
+        hourly = None
+
+        if requirements.hourly_days > 0:
+            hourly = HourlySeries(
+                time=list(map(datetime.fromisoformat, data["hourly"]["time"][hours])),
+                temperature=data["hourly"]["temperature_2m"][hours],
+                weather_code=list(
+                    map(
+                        WeatherCode.from_wmo_mapping,
+                        data["hourly"]["weather_code"][hours],
+                    )
+                ),
+                rain_probability=data["hourly"]["precipitation_probability"][hours],
+            )
 
+        return WeatherMetric(
+            time=datetime.fromisoformat(data["current"]["time"]),
+            temperature=data["current"]["temperature_2m"],
+            temperature_apparent=data["current"]["apparent_temperature"],
+            weather_code=WeatherCode.from_wmo_mapping(data["current"]["weather_code"]),
+            sunrise=datetime.fromisoformat(data["daily"]["sunrise"][0]).time(),
+            sunset=datetime.fromisoformat(data["daily"]["sunset"][0]).time(),
+            daily=daily,
+            hourly=hourly,
+        )
 
-class WeatherConfig(MetricConfig[WeatherMetric], frozen=True):
-    timezone: str = Field(description="your local timezone")
-    lat: float = Field(description="your latitude")
-    lon: float = Field(description="your longitude")
+
+class WeatherBatcher:
+    """
+    Gather locations requested within a short delay and fetch their forecasts
+    from open-meteo with a single request.
+    """
 
     API_URL: ClassVar[str] = "https://api.open-meteo.com/v1/forecast"
 
@@ -147,58 +423,145 @@ class WeatherConfig(MetricConfig[WeatherMetric], frozen=True):
         "weather_code",
     ]
 
-    @async_time_cache(timedelta(minutes=5))
-    @async_log_duration(logger, "Fetch weather data")
-    async def load(self, http: aiohttp.ClientSession) -> WeatherMetric:
+    def __init__(
+        self,
+        delay: timedelta = timedelta(milliseconds=10),
+        max_locations: int = 100,
+    ):
+        self.delay = delay
+        self.max_locations = max_locations
+        self.pending: dict[WeatherLocation, asyncio.Future[dict[str, Any]]] = {}
+        self.requirements: dict[WeatherLocation, WeatherRequirements] = {}
+        self.flush_task: asyncio.Task[None] | None = None
+
+    async def fetch(
+        self,
+        http: aiohttp.ClientSession,
+        location: WeatherLocation,
+        requirements: WeatherRequirements,
+    ) -> dict[str, Any]:
+        """
+        Fetch the raw forecast of a location, covering at least the given
+        requirements.
+        """
+        if (res := self.pending.get(location)) is None:
+            if not self.pending:
+                self.flush_task = asyncio.create_task(self.flush(http))
+
+            res = asyncio.get_running_loop().create_future()
+            self.pending[location] = res
+            self.requirements[location] = requirements
+        else:
+            self.requirements[location] = requirements.merge(
+                self.requirements[location]
+            )
+
+        return await asyncio.shield(res)
+
+    async def flush(self, http: aiohttp.ClientSession):
+        await asyncio.sleep(self.delay.total_seconds())
+        pending, requirements = self.pending, self.requirements
+        self.pending, self.requirements = {}, {}
+
+        # Locations with the same requirements share a query
+        queries: dict[WeatherRequirements, list] = {}
+
+        for location, future in pending.items():
+            queries.setdefault(requirements[location], []).append((location, future))
+
+        # Batches are fetched for all callers, which must not depend on the
+        # session of the first one
+        async with background_session(http) as http:
+            await asyncio.gather(
+                *(
+                    self._fetch_batch(http, query, batch[i : i + self.max_locations])
+                    for query, batch in queries.items()
+                    for i in range(0, len(batch), self.max_locations)
+                )
+            )
+
+    async def _fetch_batch(
+        self,
+        http: aiohttp.ClientSession,
+        requirements: WeatherRequirements,
+        batch: list[tuple[WeatherLocation, asyncio.Future[dict[str, Any]]]],
+    ):
         params = {
-            "latitude": self.lat,
-            "longitude": self.lon,
+            "latitude": ",".join(str(location.lat) for location, _ in batch),
+            "longitude": ",".join(str(location.lon) for location, _ in batch),
+            "timezone": ",".join(location.timezone for location, _ in batch),
             "daily": ",".join(self.API_DAILY_METRICS),
-            "hourly": ",".join(self.API_HOURLY_METRICS),
             "current": ",".join(self.API_CURRENT_METRICS),
-            "timezone": self.timezone,
+            "forecast_days": requirements.forecast_days,
         }
 
-        async with http.get(self.API_URL, params=params) as resp:
-            data = await resp.json()
+        if requirements.hourly_days > 0:
+            params["hourly"] = ",".join(self.API_HOURLY_METRICS)
 
-        daily = [
-            DailyData(
-                date=date.fromisoformat(time_str),
-                weather_code=WeatherCode.from_wmo_mapping(wmo_code),
-                temperature_min=temperature_min,
-                temperature_max=temperature_max,
-            )
-            for (time_str, wmo_code, temperature_min, temperature_max) in zip(
-                data["daily"]["time"],
-                data["daily"]["weather_code"],
-                data["daily"]["temperature_2m_min"],
-                data["daily"]["temperature_2m_max"],
-            )
-        ]
+        try:
+            data = await conditional_get(http, self.API_URL, parse_json, params)
 
-        hourly = [
-            HourlyData(
-                time=datetime.fromisoformat(time),
-                temperature=temperature,
-                weather_code=WeatherCode.from_wmo_mapping(wmo_code),
-                rain_probability=rain_probability,
-            )
-            for (time, temperature, wmo_code, rain_probability) in zip(
-                data["hourly"]["time"],
-                data["hourly"]["temperature_2m"],
-                data["hourly"]["weather_code"],
-                data["hourly"]["precipitation_probability"],
-            )
-        ]
+            # A single object is returned when a single location is requested
+            if not isinstance(data, list):
+                data = [data]
 
-        return WeatherMetric(
-            time=datetime.fromisoformat(data["current"]["time"]),
-            temperature=data["current"]["temperature_2m"],
-            temperature_apparent=data["current"]["apparent_temperature"],
-            weather_code=WeatherCode.from_wmo_mapping(data["current"]["weather_code"]),
-            sunrise=datetime.fromisoformat(data["daily"]["sunrise"][0]).time(),
-            sunset=datetime.fromisoformat(data["daily"]["sunset"][0]).time(),
-            daily=daily,
-            hourly=hourly,
+            if len(data) != len(batch):
+                raise ValueError(
+                    f"Got {len(data)} forecasts for {len(batch)} locations"
+                )
+        except Exception as exc:
+            for _, future in batch:
+                future.set_exception(exc)
+
+            return
+
+        logger.info("Fetched weather for %d locations", len(batch))
+
+        for (_, future), location_data in zip(batch, data):
+            future.set_result(location_data)
+
+
+weather_batcher = WeatherBatcher()
+
+
+class WeatherConfig(MetricConfig[WeatherMetric], frozen=True):
+    timezone: str = Field(description="your local timezone")
+    lat: float = Field(description="your latitude")
+    lon: float = Field(description="your longitude")
+
+    grid: float | None = Field(
+        default=None,
+        gt=0.0,
+        description=(
+            "size of the grid coordinates are snapped to so that nearby locations"
+            " share their forecast, in degrees (coordinates are kept if unset)"
+        ),
+    )
+
+    @property
+    def location(self) -> WeatherLocation:
+        def snap(coord: float) -> float:
+            if self.grid is None:
+                return coord
+
+            return round(round(coord / self.grid) * self.grid, 6)
+
+        return WeatherLocation(
+            lat=snap(self.lat),
+            lon=snap(self.lon),
+            timezone=self.timezone,
         )
+
+    async def load(
+        self,
+        http: aiohttp.ClientSession,
+        requirements: WeatherRequirements | None = None,
+    ) -> WeatherMetric:
+        """
+        Load the forecast, restricted to what is read by the widget if its
+        requirements are specified.
+        """
+        if requirements is None:
+            requirements = WeatherRequirements()
+
+        return await self.location.load(http, requirements)
@@ -5,12 +5,10 @@ from fastapi import (
     HTTPException,
 )
 
-from verdandi.state import DepState
+from verdandi.state import DepDevice, DepState
 
 
-async def auth_middleware(state: DepState, secret: str | None = None):
-    expected_secret = state.configuration.secret()
-
+def check_secret(expected_secret: str | None, secret: str | None):
     if expected_secret is None:
         return
 
@@ -25,3 +23,11 @@ async def auth_middleware(state: DepState, secret: str | None = None):
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Provided secret does not match",
         )
+
+
+async def auth_middleware(device: DepDevice, secret: str | None = None):
+    check_secret(device.configuration.secret(), secret)
+
+
+async def auth_default_middleware(state: DepState, secret: str | None = None):
+    check_secret(state.configuration.secret(), secret)
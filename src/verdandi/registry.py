@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+from datetime import datetime
+from uuid import UUID
+
+from pydantic import BaseModel, Field
+
+from verdandi.canvas import Canvas
+from verdandi.configuration import RegistryConfiguration
+
+
+class RegistryEntry(BaseModel):
+    expiration: datetime
+    canvas: Canvas
+
+
+class RegistryStats(BaseModel):
+    entries: int
+    pending: int
+    size: int
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+
+
+class ResponseRegistry(BaseModel, arbitrary_types_allowed=True):
+    """
+    Canvases that can be retrieved by their entry ID for a limited time.
+
+    Entries are indexed by expiration in a heap so that expired or evicted
+    entries are popped in logarithmic time. Canvases still being generated
+    are kept apart until they are ready.
+    """
+
+    config: RegistryConfiguration = Field(default_factory=RegistryConfiguration)
+    entries: dict[UUID, RegistryEntry] = Field(default_factory=dict)
+    pending: dict[UUID, asyncio.Future[Canvas]] = Field(default_factory=dict)
+    expiry_index: list[tuple[datetime, UUID]] = Field(default_factory=list)
+
+    # Devices entries were requested for, they can only be retrieved for these
+    owners: dict[UUID, set[str | None]] = Field(default_factory=dict)
+
+    # Canvases are shared between entries with same content, they are only
+    # accounted once in the size of the registry.
+    canvas_refs: dict[str, int] = Field(default_factory=dict)
+    size: int = 0
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    def stats(self) -> RegistryStats:
+        return RegistryStats(
+            entries=len(self.entries),
+            pending=len(self.pending),
+            size=self.size,
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+        )
+
+    def _insert(self, entry_id: UUID, entry: RegistryEntry):
+        fingerprint = entry.canvas.fingerprint
+        refs = self.canvas_refs.get(fingerprint, 0)
+
+        if refs == 0:
+            self.size += len(entry.canvas.content)
+
+        self.canvas_refs[fingerprint] = refs + 1
+        self.entries[entry_id] = entry
+        heapq.heappush(self.expiry_index, (entry.expiration, entry_id))
+
+    def _remove(self, entry_id: UUID):
+        entry = self.entries.pop(entry_id)
+        self.owners.pop(entry_id, None)
+        fingerprint = entry.canvas.fingerprint
+        self.canvas_refs[fingerprint] -= 1
+
+        if self.canvas_refs[fingerprint] == 0:
+            del self.canvas_refs[fingerprint]
+            self.size -= len(entry.canvas.content)
+
+    def _peek_oldest(self) -> tuple[datetime, UUID] | None:
+        """
+        Return the entry with earliest expiration, dropping heap items of
+        entries which were already removed.
+        """
+        while self.expiry_index:
+            expiration, entry_id = self.expiry_index[0]
+            entry = self.entries.get(entry_id)
+
+            if entry is not None and entry.expiration == expiration:
+                return expiration, entry_id
+
+            heapq.heappop(self.expiry_index)
+
+        return None
+
+    def purge(self, now: datetime):
+        """
+        Remove expired entries, then the oldest entries until the registry
+        fits its bounds.
+        """
+        while (oldest := self._peek_oldest()) is not None:
+            expiration, entry_id = oldest
+
+            if (
+                expiration > now
+                and len(self.entries) <= self.config.max_entries
+                and self.size <= self.config.max_size
+            ):
+                break
+
+            heapq.heappop(self.expiry_index)
+            self._remove(entry_id)
+
+            if expiration <= now:
+                self.expirations += 1
+            else:
+                self.evictions += 1
+
+    def set(
+        self,
+        entry_id: UUID,
+        response: asyncio.Future[Canvas],
+        now: datetime,
+        device_id: str | None = None,
+    ):
+        expiration = now + self.config.max_duration
+
+        if entry_id in self.pending or entry_id in self.entries:
+            self.owners.setdefault(entry_id, set()).add(device_id)
+
+            # Entries handed out again (eg. pre-rendered ones) can be retrieved
+            # for the whole duration from now, the previous heap item is then
+            # skipped as outdated
+            if (entry := self.entries.get(entry_id)) is not None:
+                entry.expiration = max(entry.expiration, expiration)
+                heapq.heappush(self.expiry_index, (entry.expiration, entry_id))
+
+            return
+
+        self.owners[entry_id] = {device_id}
+
+        def on_done(response: asyncio.Future[Canvas], done_at: datetime | None = None):
+            self.pending.pop(entry_id, None)
+
+            if response.cancelled() or response.exception() is not None:
+                self.owners.pop(entry_id, None)
+                return
+
+            self._insert(
+                entry_id,
+                RegistryEntry(expiration=expiration, canvas=response.result()),
+            )
+
+            # Pending responses are purged at the time they are done
+            self.purge(done_at or datetime.now())
+
+        if response.done():
+            on_done(response, now)
+        else:
+            self.pending[entry_id] = response
+            response.add_done_callback(on_done)
+
+    async def get(
+        self,
+        entry_id: UUID,
+        now: datetime,
+        device_id: str | None = None,
+    ) -> Canvas | None:
+        # Entries of other devices are not disclosed
+        if device_id not in self.owners.get(entry_id, ()):
+            self.misses += 1
+            return None
+
+        if (response := self.pending.get(entry_id)) is not None:
+            self.hits += 1
+
+            # The response is shared by all holders of the entry
+            return await asyncio.shield(response)
+
+        self.purge(now)
+        entry = self.entries.get(entry_id)
+
+        if entry is None or entry.expiration <= now:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return entry.canvas
@@ -1,72 +1,363 @@
 import asyncio
-from datetime import datetime, timedelta
+import contextvars
+import logging
+import os
+import re
+from collections.abc import AsyncGenerator
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime
 from functools import cache
+from pathlib import Path
 from typing import Annotated
-from uuid import UUID
+from uuid import UUID, uuid4
 
-from fastapi import Depends, Response
+import aiohttp
+from fastapi import Depends, HTTPException, Query, status
 from pydantic import BaseModel, Field
 
 
+from verdandi.canvas import (
+    Canvas,
+    CanvasCache,
+    PrerenderedCanvas,
+    generate_canvas,
+)
 from verdandi.configuration import ApiConfiguration
+from verdandi.registry import ResponseRegistry
+from verdandi.util.cache import LruStore
+from verdandi.util.session import set_session_provider
+from verdandi.util.tracing import Trace, current_span, current_trace
+from verdandi.widget.abs_widget import create_render_pool
 
-MAX_REGISTRY_DURATION: timedelta = timedelta(hours=3)
+logger = logging.getLogger(__name__)
 
+# Maximum number of device configurations kept in memory
+MAX_LOADED_DEVICES: int = 32
 
-class RegistryEntry(BaseModel, arbitrary_types_allowed=True):
-    request_time: datetime
-    response: asyncio.Task[Response]
+DEVICE_ID_PATTERN = re.compile(r"^[\w-]+$")
 
-    def is_obsolete(self, now: datetime) -> bool:
-        return (now - self.request_time) > MAX_REGISTRY_DURATION
 
-    async def fetch(self, now: datetime) -> Response | None:
-        if self.is_obsolete(now):
+class Device(BaseModel, arbitrary_types_allowed=True):
+    """
+    A screen configuration, along with the canvas pre-rendered for it.
+    """
+
+    device_id: str | None = None
+    configuration: ApiConfiguration
+    prerendered: PrerenderedCanvas | None = None
+    # Canvas pre-rendered for a time which has not come yet, it replaces the
+    # current one from this time on
+    upcoming: PrerenderedCanvas | None = None
+    prerender_task: asyncio.Task[None] | None = None
+
+    @classmethod
+    def load(cls, device_id: str) -> "Device | None":
+        """
+        Load the configuration of a device from the devices directory, return
+        None if there is no such device.
+        """
+        devices_dir = os.getenv("VERDANDI_DEVICES_DIR")
+
+        if devices_dir is None or not DEVICE_ID_PATTERN.match(device_id):
             return None
 
-        return await self.response
+        path = Path(devices_dir) / f"{device_id}.yaml"
+
+        if not path.is_file():
+            return None
+
+        return cls(device_id=device_id, configuration=ApiConfiguration.load(path))
+
+    def prerendered_at(self, now: datetime) -> PrerenderedCanvas | None:
+        """
+        Get the pre-rendered canvas which is displayed at `now`, if any.
+        """
+        if self.upcoming is not None and self.upcoming.is_valid_at(now):
+            self.prerendered = self.upcoming
+            self.upcoming = None
+
+        if self.prerendered is not None and self.prerendered.is_valid_at(now):
+            return self.prerendered
+
+        return None
+
+    def stop_prerender(self):
+        if self.prerender_task is not None:
+            self.prerender_task.cancel()
+            self.prerender_task = None
+
+
+class CanvasGeneration(BaseModel, arbitrary_types_allowed=True):
+    """
+    A canvas generation in progress, along with the entry ID it can be
+    retrieved with and the trace of its stages.
+    """
+
+    entry_id: UUID
+    task: asyncio.Task[Canvas]
+    trace: Trace
 
 
 class AppState(BaseModel, arbitrary_types_allowed=True):
-    configuration: ApiConfiguration = Field(default_factory=ApiConfiguration.load)
-    response_registry: dict[UUID, RegistryEntry] = Field(default_factory=dict)
-    response_registry_lock: asyncio.Lock = Field(default_factory=asyncio.Lock)
+    default_device: Device = Field(
+        default_factory=lambda: Device(configuration=ApiConfiguration.load())
+    )
+
+    devices: LruStore[str, Device] = Field(
+        default_factory=lambda: LruStore(
+            MAX_LOADED_DEVICES,
+            on_evict=lambda _, device: device.stop_prerender(),
+        )
+    )
 
-    async def clear_registry(self, now: datetime | None = None):
-        if now is None:
-            now = datetime.now()
+    response_registry: ResponseRegistry = Field(
+        default_factory=lambda data: ResponseRegistry(
+            config=data["default_device"].configuration.registry
+        )
+    )
 
-        async with self.response_registry_lock:
-            popped_keys = {
-                key
-                for key, val in self.response_registry.items()
-                if val.is_obsolete(now)
-            }
+    canvas_cache: CanvasCache = Field(default_factory=CanvasCache)
+    in_flight: dict[tuple[str, datetime], CanvasGeneration] = Field(
+        default_factory=dict
+    )
 
-            for key in popped_keys:
-                del self.response_registry[key]
+    # Traces of the last generations, indexed by entry ID
+    traces: LruStore[UUID, Trace] = Field(default_factory=lambda: LruStore(64))
 
-    async def get_response(self, entry_id: UUID) -> Response | None:
-        now = datetime.now()
-        entry = self.response_registry.get(entry_id)
+    http: aiohttp.ClientSession | None = None
+    render_pool: ProcessPoolExecutor | None = None
+    running: bool = False
 
-        if entry is None:
+    @property
+    def configuration(self) -> ApiConfiguration:
+        return self.default_device.configuration
+
+    def get_device(self, device_id: str | None) -> Device | None:
+        """
+        Get a device by its ID, its configuration is loaded on first access.
+        """
+        if device_id is None:
+            return self.default_device
+
+        if (device := self.devices.get(device_id)) is not None:
+            return device
+
+        if (device := Device.load(device_id)) is None:
             return None
 
-        return await entry.fetch(now)
+        logger.info("Loaded configuration for device %s", device_id)
+        self.devices.set(device_id, device)
+
+        if self.running:
+            self.start_prerender(device)
+
+        return device
+
+    async def start(self):
+        """
+        Open shared resources and start background tasks.
+        """
+        assert not self.running
+        self.running = True
+        self.http = self.configuration.http.create_session()
+
+        if (processes := self.configuration.render_processes) is not None:
+            self.render_pool = create_render_pool(processes)
+
+        self.start_prerender(self.default_device)
+
+        for device in self.devices.entries.values():
+            self.start_prerender(device)
+
+    async def stop(self):
+        self.running = False
+
+        prerender_tasks = [
+            device.prerender_task
+            for device in (self.default_device, *self.devices.entries.values())
+            if device.prerender_task is not None
+        ]
+
+        for device in (self.default_device, *self.devices.entries.values()):
+            device.stop_prerender()
+
+        await asyncio.gather(*prerender_tasks, return_exceptions=True)
+
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
 
-    async def set_response(self, entry_id: UUID, task: asyncio.Task[Response]):
-        now = datetime.now()
-        await self.clear_registry(now)
-        entry = RegistryEntry(request_time=now, response=task)
+        if self.render_pool is not None:
+            self.render_pool.shutdown(cancel_futures=True)
+            self.render_pool = None
 
-        async with self.response_registry_lock:
-            self.response_registry[entry_id] = entry
+    @asynccontextmanager
+    async def http_session(self) -> AsyncGenerator[aiohttp.ClientSession]:
+        """
+        Yield the shared HTTP session, or a short-lived one if it was not
+        opened (eg. when the app lifespan is not handled).
+        """
+        if self.http is not None:
+            yield self.http
+            return
+
+        async with self.configuration.http.create_session() as http:
+            yield http
+
+    async def get_response(
+        self,
+        entry_id: UUID,
+        device_id: str | None = None,
+    ) -> Canvas | None:
+        return await self.response_registry.get(entry_id, datetime.now(), device_id)
+
+    def set_response(
+        self,
+        entry_id: UUID,
+        task: asyncio.Future[Canvas],
+        device_id: str | None = None,
+    ):
+        self.response_registry.set(entry_id, task, datetime.now(), device_id)
+
+    async def render_canvas(
+        self,
+        configuration: ApiConfiguration,
+        now: datetime,
+    ) -> Canvas:
+        """
+        Render the canvas that will be displayed at `now`.
+        """
+        async with self.http_session() as http:
+            return await generate_canvas(
+                configuration,
+                now,
+                http,
+                self.canvas_cache,
+                self.render_pool,
+            )
+
+    def generate(
+        self,
+        configuration: ApiConfiguration,
+        now: datetime,
+    ) -> CanvasGeneration:
+        """
+        Start the generation of the canvas displayed at `now`, or join the
+        generation in progress for the same configuration and minute.
+        """
+        key = (configuration.fingerprint, now.replace(second=0, microsecond=0))
+
+        if (generation := self.in_flight.get(key)) is not None:
+            logger.info("Joining canvas generation %s", generation.entry_id)
+            return generation
+
+        entry_id = uuid4()
+        trace = Trace()
+
+        # Spans of the generation are recorded in its own trace
+        context = contextvars.copy_context()
+        context.run(current_trace.set, trace)
+        context.run(current_span.set, None)
+
+        generation = CanvasGeneration(
+            entry_id=entry_id,
+            task=asyncio.create_task(
+                self.render_canvas(configuration, now),
+                name=f"generate-canvas-{entry_id}",
+                context=context,
+            ),
+            trace=trace,
+        )
+
+        self.in_flight[key] = generation
+        self.traces.set(entry_id, trace)
+        generation.task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+
+        if (trace_file := self.configuration.trace_file) is not None:
+            generation.task.add_done_callback(lambda _: trace.export(trace_file))
+
+        return generation
+
+    async def prerender(self, device: Device, now: datetime):
+        generation = self.generate(device.configuration, now)
+
+        # Other requests may have joined the generation, it is not cancelled
+        # along with the pre-rendering
+        canvas = await asyncio.shield(generation.task)
+
+        prerendered = PrerenderedCanvas(
+            entry_id=generation.entry_id,
+            time=now,
+            next_update=device.configuration.next_update(now),
+            canvas=canvas,
+        )
+
+        # Canvases rendered ahead of their time are kept apart until then
+        if now <= datetime.now().astimezone():
+            device.prerendered = prerendered
+        else:
+            device.upcoming = prerendered
+
+    async def prerender_forever(self, device: Device):
+        """
+        Keep a canvas ready by rendering it slightly before each update.
+        """
+        configuration = device.configuration
+        advance = configuration.prerender_advance
+        assert advance is not None
+        now = datetime.now().astimezone()
+
+        while True:
+            try:
+                await self.prerender(device, now)
+            except Exception:
+                logger.exception("Could not pre-render canvas for %s", now.isoformat())
+
+            now = configuration.next_update(max(now, datetime.now().astimezone()))
+            logger.info("Next canvas pre-rendering for %s", now.isoformat())
+            delay = (now - advance - datetime.now().astimezone()).total_seconds()
+            await asyncio.sleep(max(0.0, delay))
+
+    def start_prerender(self, device: Device):
+        if device.configuration.prerender_advance is None:
+            return
+
+        device.prerender_task = asyncio.create_task(
+            self.prerender_forever(device),
+            name=f"prerender-canvas-{device.device_id or 'default'}",
+        )
 
     @staticmethod
     @cache
     def get_shared_state():
-        return AppState()
+        state = AppState()
+
+        # Background work uses the session of the app rather than the one of
+        # the request it was started by
+        set_session_provider(state.http_session)
+        return state
 
 
 DepState = Annotated[AppState, Depends(AppState.get_shared_state)]
+
+
+def get_device(
+    state: DepState,
+    device: Annotated[
+        str | None,
+        Query(title="ID of the device, the default configuration is used if unset"),
+    ] = None,
+) -> Device:
+    res = state.get_device(device)
+
+    if res is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Unknown device",
+        )
+
+    return res
+
+
+DepDevice = Annotated[Device, Depends(get_device)]
@@ -9,7 +9,7 @@ from contextlib import asynccontextmanager
 
 import aiohttp
 import time_machine
-from aioresponses import aioresponses
+from aioresponses import CallbackResult, aioresponses
 from httpx import ASGITransport, AsyncClient
 
 
@@ -27,12 +27,22 @@ async def get_mocked_http() -> AsyncGenerator[aiohttp.ClientSession, None]:
             aioresponses() as mock,
         ):
             with open(FIXTURES_PATH / "open-meteo.json") as f:
-                mock.get(
-                    re.compile("^https://api.open-meteo.com/v1/forecast.*$"),
-                    payload=json.load(f),
-                    repeat=True,
+                weather = json.load(f)
+
+            def weather_callback(url, **kwargs) -> CallbackResult:
+                # Forecasts of several locations are returned as a list
+                locations = len(kwargs["params"]["latitude"].split(","))
+
+                return CallbackResult(
+                    payload=weather if locations == 1 else [weather] * locations
                 )
 
+            mock.get(
+                re.compile("^https://api.open-meteo.com/v1/forecast.*$"),
+                callback=weather_callback,
+                repeat=True,
+            )
+
             with open(FIXTURES_PATH / "velib" / "station_information.json") as f:
                 mock.get(
                     re.compile(
@@ -92,7 +102,11 @@ def secret() -> str:
 @pytest.fixture
 async def client(base_url: str, monkeypatch, http) -> AsyncGenerator[AsyncClient]:
     test_config_path = FIXTURES_PATH / "test-config.yaml"
-    test_env = {"VERDANDI_CONFIG_FILE": str(test_config_path)}
+
+    test_env = {
+        "VERDANDI_CONFIG_FILE": str(test_config_path),
+        "VERDANDI_DEVICES_DIR": str(FIXTURES_PATH / "devices"),
+    }
 
     with mock.patch.dict(os.environ, test_env, clear=True):
         async with AsyncClient(
@@ -114,6 +128,7 @@ async def client_with_secret(
 
     test_env = {
         "VERDANDI_CONFIG_FILE": str(test_config_path),
+        "VERDANDI_DEVICES_DIR": str(FIXTURES_PATH / "devices"),
         "VERDANDI_SECRET": secret,
     }
 
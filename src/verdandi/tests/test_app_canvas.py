@@ -1,9 +1,17 @@
+import asyncio
+import json
+from datetime import datetime, timedelta
+from unittest import mock
 from uuid import uuid4
 
 import time_machine
 import pytest
 from httpx import AsyncClient
 
+from verdandi.canvas import Canvas, CanvasFormat
+from verdandi.state import AppState
+from verdandi.util.tracing import export_executor
+
 
 async def test_direct(client: AsyncClient):
     resp = await client.get("/canvas/direct/")
@@ -41,6 +49,22 @@ async def test_secret_redirect(client_with_secret: AsyncClient, secret: str):
     assert resp.status_code == 200
 
 
+async def test_secret_other_device(client_with_secret: AsyncClient, secret: str):
+    resp = await client_with_secret.get(f"/canvas/redirect/?secret={secret}")
+    entry_url = resp.json()["url"].split("?")[0]
+
+    # Entries can't be retrieved through a device which does not require a
+    # secret, nor can routes which are not bound to a device
+    resp = await client_with_secret.get(entry_url, params={"device": "kitchen"})
+    assert resp.status_code == 404
+
+    resp = await client_with_secret.get("/metrics", params={"device": "kitchen"})
+    assert resp.status_code == 401
+
+    resp = await client_with_secret.get("/metrics", params={"secret": secret})
+    assert resp.status_code == 200
+
+
 @pytest.mark.parametrize("wait", ["false", "true"])
 async def test_async(client: AsyncClient, wait: str):
     resp_new = await client.get("/canvas/redirect/", params={"wait": wait})
@@ -84,3 +108,274 @@ async def test_registry(client: AsyncClient):
 
     with time_machine.travel(time_fetch_invalid):
         assert not await is_valid()
+
+
+async def test_etag(client: AsyncClient):
+    resp = await client.get("/canvas/direct/")
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+
+    # Nothing changed in between, the same canvas is served
+    resp = await client.get("/canvas/direct/")
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == etag
+
+    resp = await client.get("/canvas/direct/", headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert resp.headers["ETag"] == etag
+    assert resp.content == b""
+
+
+async def test_etag_redirect(client: AsyncClient):
+    resp = await client.get("/canvas/redirect/", params={"wait": True})
+    url = resp.json()["url"]
+
+    resp = await client.get(url)
+    assert resp.status_code == 200
+    etag = resp.headers["ETag"]
+
+    resp = await client.get(url, headers={"If-None-Match": f"W/{etag}, other"})
+    assert resp.status_code == 304
+
+    resp = await client.get(url, headers={"If-None-Match": '"other"'})
+    assert resp.status_code == 200
+
+
+async def test_prerendered(client: AsyncClient, monkeypatch):
+    state = AppState.get_shared_state()
+    device = state.default_device
+    monkeypatch.setattr(device, "prerendered", None)
+    now = datetime.now().astimezone()
+    await state.prerender(device, now)
+    assert device.prerendered is not None
+
+    with mock.patch.object(AppState, "render_canvas") as render_canvas:
+        resp = await client.get("/canvas/redirect/")
+        render_canvas.assert_not_called()
+
+    resp = await client.get(resp.json()["url"])
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] == device.prerendered.canvas.etag
+
+    # The pre-rendered canvas is not served after its update time
+    assert device.prerendered.next_update > now
+    update_time = device.prerendered.next_update + timedelta(seconds=1)
+
+    with (
+        time_machine.travel(update_time, tick=False),
+        mock.patch.object(
+            AppState,
+            "render_canvas",
+            return_value=device.prerendered.canvas,
+        ) as render_canvas,
+    ):
+        await client.get("/canvas/redirect/")
+        render_canvas.assert_called_once()
+
+
+async def test_prerendered_ahead(client: AsyncClient, monkeypatch):
+    state = AppState.get_shared_state()
+    device = state.default_device
+    now = datetime.now().astimezone()
+    monkeypatch.setattr(device, "prerendered", None)
+    await state.prerender(device, now)
+    current = device.prerendered
+    assert current is not None
+
+    # A canvas rendered ahead of its time is not served before this time
+    monkeypatch.setattr(device, "upcoming", None)
+    await state.prerender(device, current.next_update)
+    assert device.upcoming is not None
+    assert device.prerendered_at(now) is current
+    assert device.prerendered_at(current.next_update) is not current
+    assert device.prerendered is not current
+
+
+async def test_stats_http(client: AsyncClient):
+    state = AppState.get_shared_state()
+    await state.start()
+
+    try:
+        resp = await client.get("/stats/http/")
+        assert resp.status_code == 200
+        assert resp.json()["limit_per_host"] == state.configuration.http.limit_per_host
+
+        # The shared session is used for canvas generations
+        resp = await client.get("/canvas/direct/")
+        assert resp.status_code == 200
+    finally:
+        await state.stop()
+
+    resp = await client.get("/stats/http/")
+    assert resp.json() is None
+
+
+@pytest.mark.parametrize(
+    "device, expected_status",
+    [
+        ("kitchen", 200),
+        ("unknown", 404),
+        ("../test-config", 404),
+    ],
+)
+async def test_device(client: AsyncClient, device: str, expected_status: int):
+    resp = await client.get("/canvas/direct/", params={"device": device})
+    assert resp.status_code == expected_status
+
+
+async def test_device_redirect(client: AsyncClient):
+    resp = await client.get("/canvas/redirect/", params={"device": "kitchen"})
+    assert resp.status_code == 200
+    url = resp.json()["url"]
+    assert "device=kitchen" in url
+
+    resp = await client.get(url)
+    assert resp.status_code == 200
+
+    # Devices render distinct canvases
+    resp_default = await client.get("/canvas/direct/")
+    assert resp_default.headers["ETag"] != resp.headers["ETag"]
+
+
+async def test_coalesce(client: AsyncClient, monkeypatch):
+    state = AppState.get_shared_state()
+    monkeypatch.setattr(state.default_device, "prerendered", None)
+    resp = await client.get("/canvas/direct/")
+    canvas = Canvas(fingerprint=resp.headers["ETag"].strip('"'), content=resp.content)
+
+    async def render_canvas(*_args) -> Canvas:
+        await asyncio.sleep(0.05)
+        return canvas
+
+    with mock.patch.object(
+        AppState,
+        "render_canvas",
+        side_effect=render_canvas,
+    ) as render_canvas_mock:
+        resps = await asyncio.gather(
+            client.get("/canvas/redirect/"),
+            client.get("/canvas/redirect/"),
+            client.get("/canvas/direct/"),
+        )
+
+        render_canvas_mock.assert_called_once()
+
+    # All requests share the same entry and content
+    assert resps[0].json()["url"] == resps[1].json()["url"]
+    assert resps[2].content == canvas.content
+
+    resp = await client.get(resps[0].json()["url"])
+    assert resp.content == canvas.content
+
+
+async def test_coalesce_cancel(client: AsyncClient, monkeypatch):
+    state = AppState.get_shared_state()
+    monkeypatch.setattr(state.default_device, "prerendered", None)
+    resp = await client.get("/canvas/direct/")
+    canvas = Canvas(fingerprint=resp.headers["ETag"].strip('"'), content=resp.content)
+
+    async def render_canvas(*_args) -> Canvas:
+        await asyncio.sleep(0.05)
+        return canvas
+
+    with mock.patch.object(AppState, "render_canvas", side_effect=render_canvas):
+        now = datetime.now().astimezone()
+        prerender = asyncio.create_task(state.prerender(state.default_device, now))
+        await asyncio.sleep(0)
+
+        # Cancelling the pre-rendering does not cancel the generation it shares
+        # with other requests
+        direct = asyncio.create_task(client.get("/canvas/direct/"))
+        await asyncio.sleep(0.01)
+        prerender.cancel()
+        resp = await direct
+
+    assert resp.status_code == 200
+    assert resp.content == canvas.content
+
+
+async def test_metrics(client: AsyncClient):
+    resp = await client.get("/canvas/direct/")
+    assert resp.status_code == 200
+
+    resp = await client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"].startswith("text/plain")
+
+    samples = dict(
+        line.rsplit(" ", 1)
+        for line in resp.text.splitlines()
+        if not line.startswith("#")
+    )
+
+    assert float(samples["verdandi_canvas_generation_seconds_count"]) >= 1
+    assert 'verdandi_widget_fetch_seconds_count{widget="WeatherWeek3x1"}' in samples
+    assert "verdandi_registry_size_bytes" in samples
+    assert "verdandi_in_flight_generations" in samples
+
+
+async def test_server_timing(client: AsyncClient, monkeypatch, tmp_path):
+    state = AppState.get_shared_state()
+    trace_file = tmp_path / "traces.jsonl"
+    monkeypatch.setattr(state.configuration, "trace_file", trace_file)
+
+    resp = await client.get("/canvas/direct/")
+    assert resp.status_code == 200
+
+    timings = [
+        entry.split(";")[0] for entry in resp.headers["Server-Timing"].split(", ")
+    ]
+
+    assert "request" in timings
+    assert "generate" in timings
+    assert "fetch.WeatherWeek3x1" in timings
+
+    # Spans of the generation are exported to the trace file, once the
+    # background writes are done
+    await asyncio.get_running_loop().run_in_executor(export_executor, lambda: None)
+    [trace] = map(json.loads, trace_file.read_text().splitlines())
+    [spans] = [s["spans"] for r in trace["resourceSpans"] for s in r["scopeSpans"]]
+    [root] = [span for span in spans if "parentSpanId" not in span]
+    assert root["name"] == "generate"
+    assert all(span["traceId"] == root["traceId"] for span in spans)
+
+    resp = await client.get("/canvas/redirect/", params={"wait": True})
+    assert "Server-Timing" in resp.headers
+    resp = await client.get(resp.json()["url"])
+    assert "Server-Timing" in resp.headers
+
+
+@pytest.mark.parametrize(
+    "params, headers, canvas_format",
+    [
+        ({}, {}, CanvasFormat.PNG),
+        ({"format": "bmp1"}, {}, CanvasFormat.BMP1),
+        ({}, {"Accept": "image/bmp"}, CanvasFormat.BMP2),
+        ({}, {"Accept": "application/octet-stream; bits=1"}, CanvasFormat.RAW1),
+        ({"format": "raw2"}, {"Accept": "image/bmp"}, CanvasFormat.RAW2),
+    ],
+)
+async def test_formats(client: AsyncClient, params, headers, canvas_format):
+    resp = await client.get("/canvas/direct/", params=params, headers=headers)
+    assert resp.status_code == 200
+    assert resp.headers["Content-Type"] == canvas_format.media_type
+    assert resp.headers["Vary"] == "Accept"
+    etag = resp.headers["ETag"]
+
+    match canvas_format:
+        case CanvasFormat.PNG:
+            assert resp.content.startswith(b"\x89PNG")
+        case CanvasFormat.BMP1 | CanvasFormat.BMP2:
+            assert resp.content.startswith(b"BM")
+            assert resp.content[28] == canvas_format.bits
+        case CanvasFormat.RAW1 | CanvasFormat.RAW2:
+            assert len(resp.content) == canvas_format.bits * 800 // 8 * 480
+
+    # Each format is identified by its own tag
+    resp = await client.get(
+        "/canvas/direct/",
+        params=params,
+        headers={**headers, "If-None-Match": etag},
+    )
+
+    assert resp.status_code == 304
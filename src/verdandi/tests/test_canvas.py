@@ -0,0 +1,120 @@
+import asyncio
+from datetime import datetime, timedelta
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+import aiohttp
+
+import pytest
+
+from verdandi.canvas import (
+    CanvasCache,
+    CanvasFormat,
+    _late_renderings,
+    generate_canvas,
+)
+from verdandi.configuration import ApiConfiguration
+from verdandi.tests.conftest import FIXTURES_PATH
+from verdandi.widget.abs_widget import Widget, create_render_pool
+from verdandi.widget.showcase import Showcase2x1
+from verdandi.widget.weather import WeatherWeek3x1
+
+
+async def test_tile_fingerprint(http: aiohttp.ClientSession):
+    widget = WeatherWeek3x1.example()
+    now = datetime.now().astimezone()
+    weather = (await widget.load_metrics(http))["weather"]
+    fingerprint = widget.fingerprint(now, {"weather": weather})
+
+    # Only daily forecast is displayed by this widget
+    weather_update = weather.model_copy(update={"temperature": 42.0})
+    assert widget.fingerprint(now, {"weather": weather_update}) == fingerprint
+
+    temperature_max = [42.0, *weather.daily.temperature_max[1:]]
+    daily_update = weather.daily.model_copy(update={"temperature_max": temperature_max})
+    weather_update = weather.model_copy(update={"daily": daily_update})
+    assert widget.fingerprint(now, {"weather": weather_update}) != fingerprint
+
+
+async def test_tile_time_bucket(http: aiohttp.ClientSession):
+    widget = Showcase2x1.example()
+    metrics = await widget.load_metrics(http)
+    tz = ZoneInfo("Europe/Paris")
+    midnight = datetime(2025, 12, 24, 0, 0, tzinfo=tz)
+    morning = datetime(2025, 12, 24, 10, 0, tzinfo=tz)
+
+    # Tiles are shared by the whole bucket, so they are drawn the same
+    assert widget.fingerprint(midnight, metrics) == widget.fingerprint(morning, metrics)
+    assert widget._init_and_draw(midnight, **metrics) == widget._init_and_draw(
+        morning, **metrics
+    )
+
+
+async def test_tile_cache(http: aiohttp.ClientSession):
+    configuration = ApiConfiguration.load(FIXTURES_PATH / "test-config.yaml")
+    now = datetime.now().astimezone()
+    cache = CanvasCache()
+
+    with mock.patch.object(
+        Widget,
+        "draw_metrics",
+        autospec=True,
+        side_effect=Widget.draw_metrics,
+    ) as draw_metrics:
+        canvas = await generate_canvas(configuration, now, http, cache)
+        assert draw_metrics.call_count == len(configuration.widgets)
+
+        # Drop the canvas to force its composition from cached tiles
+        cache.canvases.entries.clear()
+        assert await generate_canvas(configuration, now, http, cache) == canvas
+        assert draw_metrics.call_count == len(configuration.widgets)
+
+
+async def test_render_pool(http: aiohttp.ClientSession):
+    configuration = ApiConfiguration.load(FIXTURES_PATH / "test-config.yaml")
+    now = datetime.now().astimezone()
+    canvas = await generate_canvas(configuration, now, http)
+
+    with create_render_pool(2) as render_pool:
+        assert (
+            await generate_canvas(configuration, now, http, render_pool=render_pool)
+            == canvas
+        )
+
+
+async def test_deadline(http: aiohttp.ClientSession):
+    configuration = ApiConfiguration.load(FIXTURES_PATH / "test-config.yaml")
+    now = datetime.now().astimezone()
+    canvas = await generate_canvas(configuration, now, http)
+
+    configuration.widget_deadline = timedelta(milliseconds=50)
+    cache = CanvasCache()
+
+    load_metrics = WeatherWeek3x1.load_metrics
+
+    async def slow_load_metrics(self, http):
+        await asyncio.sleep(0.2)
+        return await load_metrics(self, http)
+
+    with mock.patch.object(WeatherWeek3x1, "load_metrics", slow_load_metrics):
+        # The late widget is displayed as a placeholder
+        assert await generate_canvas(configuration, now, http, cache) != canvas
+
+        # Then from its tile rendered in background
+        await asyncio.gather(*_late_renderings)
+        assert await generate_canvas(configuration, now, http, cache) == canvas
+
+
+@pytest.mark.parametrize(
+    "accept, canvas_format",
+    [
+        (None, CanvasFormat.PNG),
+        ("*/*", CanvasFormat.PNG),
+        ("text/html", CanvasFormat.PNG),
+        ("image/bmp;bits=1, image/png;q=0.5", CanvasFormat.BMP1),
+        ("image/png;q=0.5, application/octet-stream", CanvasFormat.RAW2),
+        ("image/bmp;q=0, */*;q=0.1", CanvasFormat.PNG),
+    ],
+)
+def test_negotiate(accept, canvas_format):
+    assert CanvasFormat.negotiate(accept) == canvas_format
@@ -1,12 +1,16 @@
+import asyncio
 import aiohttp
-from datetime import datetime, date
+from datetime import datetime, date, time, timedelta
 from typing import AsyncGenerator
+from unittest import mock
 from zoneinfo import ZoneInfo
 
 import pytest
+import time_machine
 from pydantic import AnyHttpUrl
 
-from verdandi.metric.ics import ICSConfig, ICSMetric, ICSCalendar
+from verdandi.metric import ics as ics_module
+from verdandi.metric.ics import ICSConfig, ICSEvent, ICSMetric, ICSCalendar
 
 
 @pytest.fixture
@@ -56,3 +60,158 @@ def test_showcase_end_of_year(ics: ICSMetric):
     tz = ZoneInfo("Europe/Paris")
     dt = datetime(2025, 12, 31, 12, 0, tzinfo=tz)
     assert ics.next_showcase_event(dt).date_start.date() == date(2026, 12, 25)  # ty:ignore[unresolved-attribute]
+
+
+def test_index(ics: ICSMetric):
+    tz = ZoneInfo("Europe/Paris")
+    day = date(2025, 11, 1)
+
+    for _ in range(90):
+        midnight = datetime.combine(day, time(0, 0), tzinfo=tz)
+        noon = datetime.combine(day, time(12, 0), tzinfo=tz)
+
+        assert ics.on_date(day) == [
+            event
+            for event in ics.all_events
+            if event.date_start.date() <= day and event.date_end > midnight
+        ]
+
+        assert ics.between(midnight, noon) == [
+            event
+            for event in ics.all_events
+            if event.date_start < noon and event.date_end > midnight
+        ]
+
+        occupancy = ics.occupancy(day)
+        assert occupancy.events == ics.on_date(day)
+        assert all(event.is_full_day(day) for event in occupancy.full_day)
+        assert len(occupancy.full_day) + len(occupancy.periods) == len(occupancy.events)
+        day += timedelta(days=1)
+
+    # Results can be modified without altering the index
+    day = date(2025, 12, 26)
+    ics.on_date(day).clear()
+    assert ics.on_date(day)
+
+
+@pytest.mark.parametrize(
+    "start",
+    [
+        datetime(2025, 11, 15, 19, 15, tzinfo=ZoneInfo("Europe/Paris")),
+        datetime(2025, 12, 24, 8, 0, tzinfo=ZoneInfo("Europe/Paris")),
+    ],
+)
+def test_iter_days(ics: ICSMetric, start: datetime):
+    expected = {}
+
+    for event in ics.all_events:
+        if event.date_end < start:
+            continue
+
+        day = event.date_start.date()
+
+        if event.date_start < event.date_end:
+            last_day = (event.date_end - timedelta(seconds=1)).date()
+        else:
+            last_day = day
+
+        while day <= last_day:
+            expected.setdefault(day, []).append(event)
+
+            day += timedelta(days=1)
+
+    assert list(ics.iter_days(start)) == sorted(expected.items())
+
+
+def test_iter_days_ongoing():
+    tz = ZoneInfo("Europe/Paris")
+    calendar = ICSCalendar(label="Holidays", url=AnyHttpUrl("https://calendar-url/"))
+
+    def event(summary: str, start: datetime, end: datetime) -> ICSEvent:
+        return ICSEvent(
+            summary=summary,
+            calendar=calendar,
+            date_start=start.replace(tzinfo=tz),
+            date_end=end.replace(tzinfo=tz),
+            labels=set(),
+        )
+
+    over = event("Over", datetime(2025, 12, 19, 10), datetime(2025, 12, 19, 11))
+    vacation = event("Vacation", datetime(2025, 12, 20), datetime(2025, 12, 23))
+    meeting = event("Meeting", datetime(2025, 12, 23, 10), datetime(2025, 12, 23, 11))
+    all_events = [over, vacation, meeting]
+    ics = ICSMetric(all_events=all_events, upcoming=all_events, showcase=[])
+
+    # Ongoing events are listed from their first day
+    assert list(ics.iter_days(datetime(2025, 12, 21, 9, tzinfo=tz))) == [
+        (date(2025, 12, 20), [vacation]),
+        (date(2025, 12, 21), [vacation]),
+        (date(2025, 12, 22), [vacation]),
+        (date(2025, 12, 23), [meeting]),
+    ]
+
+
+async def test_calendar_sharing(http: aiohttp.ClientSession):
+    ics_module._parsed_calendars.entries.clear()
+    ics_module.load_calendar_events.cache_store.slots.clear()
+
+    def config(label: str, timezone: str) -> ICSConfig:
+        return ICSConfig(
+            timezone=timezone,
+            calendars=(
+                ICSCalendar(
+                    label=label,
+                    url=AnyHttpUrl("https://calendar-url/french-holidays.ics"),
+                ),
+            ),
+        )
+
+    with mock.patch.object(ics_module, "events", wraps=ics_module.events) as events:
+        first = await config("Holidays", "Europe/Paris").load(http)
+
+        # The calendar is fetched and parsed once for all configurations
+        second = await config("Jours fériés", "America/New_York").load(http)
+        assert events.call_count == 1
+
+        # Its content is not parsed again when it is fetched again
+        ics_module.load_calendar_events.cache_store.slots.clear()
+        await config("Holidays", "Europe/London").load(http)
+        assert events.call_count == 1
+
+    assert [e.summary for e in first.all_events] == [
+        e.summary for e in second.all_events
+    ]
+
+
+async def test_window_rollover(http: aiohttp.ClientSession):
+    ics_module._parsed_calendars.entries.clear()
+    ics_module.load_calendar_events.cache_store.slots.clear()
+    ICSConfig.load.cache_store.slots.clear()
+
+    config = ICSConfig(
+        timezone="Europe/Paris",
+        calendars=(
+            ICSCalendar(
+                label="Holidays",
+                url=AnyHttpUrl("https://calendar-url/french-holidays.ics"),
+            ),
+        ),
+    )
+
+    with mock.patch.object(ics_module, "events", wraps=ics_module.events) as events:
+        with time_machine.travel("2025-11-15 23:50 +00:00"):
+            await config.load(http)
+
+        # Events expanded over the previous day are served while the calendar
+        # is expanded over the new one in background
+        with time_machine.travel("2025-11-16 02:20 +00:00"):
+            metric = await config.load(http)
+            await asyncio.gather(*ICSConfig.load.cache_refresh_tasks.values())
+            await asyncio.gather(
+                *ics_module.load_calendar_events.cache_refresh_tasks.values()
+            )
+
+        assert events.call_count == 2
+        assert events.call_args.kwargs["end"].date() == date(2027, 11, 17)
+        assert len(ics_module.load_calendar_events.cache_store) == 1
+        assert metric.all_events
@@ -1,8 +1,11 @@
 import aiohttp
 import pytest
+from datetime import datetime
 from typing import AsyncGenerator
+from unittest import mock
 
 from verdandi.metric.velib import VelibConfig, VelibMetric
+from verdandi.widget.velib import Velib1x1
 
 
 @pytest.fixture
@@ -16,3 +19,29 @@ def test_velib(velib: VelibMetric):
     assert velib.electric == 2
     assert velib.parking == 16
     assert velib.capacity == 19
+
+
+async def test_fallback(http: aiohttp.ClientSession):
+    widget = Velib1x1(velib=VelibConfig(station_id=213686196))
+    now = datetime.now().astimezone()
+    fresh = await widget.load_metrics(http)
+    assert fresh["velib"].stale_since is None
+
+    with mock.patch.object(
+        VelibConfig,
+        "load",
+        autospec=True,
+        side_effect=aiohttp.ClientError("Service unavailable"),
+    ):
+        stale = await widget.load_metrics(http)
+
+    # The last known value is served, and drawn with a marker
+    assert stale["velib"].stale_since == fresh["velib"].loaded_at
+    assert stale["velib"].station_name == fresh["velib"].station_name
+    assert widget.fingerprint(now, stale) != widget.fingerprint(now, fresh)
+    assert widget._init_and_draw(now, **stale) != widget._init_and_draw(now, **fresh)
+
+    # Other errors are not hidden behind the last known value
+    with mock.patch.object(VelibConfig, "load", autospec=True, side_effect=KeyError):
+        with pytest.raises(KeyError):
+            await widget.load_metrics(http)
@@ -1,10 +1,20 @@
-from datetime import datetime
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from unittest import mock
 
 import aiohttp
 import pytest
 from typing import AsyncGenerator
 
-from verdandi.metric.weather import WeatherConfig, WeatherMetric
+from verdandi.metric.weather import (
+    WeatherBatcher,
+    WeatherConfig,
+    WeatherMetric,
+    WeatherRequirements,
+)
+from verdandi.util import session as session_module
+from verdandi.widget.weather import WeatherRecap3x2, WeatherWeek3x1
 
 
 @pytest.fixture
@@ -55,3 +65,113 @@ def test_weather_interpolate_oob(weather: WeatherMetric):
         weather.interpolate_temperature_at(datetime.fromisoformat("2026-01-15T12:00"))
         == 2.3
     )
+
+
+def test_weather_interpolate_range(weather: WeatherMetric):
+    start = datetime.fromisoformat("2025-11-14T23:30")
+    temperatures = weather.hourly.interpolate_temperatures(
+        start, start + timedelta(hours=3), 13
+    )
+
+    assert temperatures == [
+        weather.interpolate_temperature_at(start + timedelta(minutes=15 * i))
+        for i in range(13)
+    ]
+
+
+def test_weather_bounds(weather: WeatherMetric):
+    start = datetime.fromisoformat("2025-11-15T00:30")
+
+    for hours in (0, 1, 5, 24, 100):
+        end = start + timedelta(hours=hours)
+
+        temperatures = [
+            pt.temperature
+            for pt in map(weather.hourly.__getitem__, range(len(weather.hourly)))
+            if start <= pt.time <= end
+        ]
+
+        temperatures.append(weather.interpolate_temperature_at(start))
+        temperatures.append(weather.interpolate_temperature_at(end))
+        expected = (min(temperatures), max(temperatures))
+        assert weather.temerature_bounds(start, end) == expected
+
+
+async def test_weather_batching(http: aiohttp.ClientSession):
+    configs = [
+        WeatherConfig(lat=45.7601, lon=4.8299, timezone="Europe/Paris", grid=0.01),
+        WeatherConfig(lat=45.7599, lon=4.8301, timezone="Europe/Paris", grid=0.01),
+        WeatherConfig(lat=43.2965, lon=5.3698, timezone="Europe/Paris", grid=0.01),
+    ]
+
+    # Nearby coordinates share the same grid cell, coordinates are kept as is
+    # unless a grid is set
+    assert configs[0].location == configs[1].location
+    assert configs[0].location != configs[2].location
+    assert (
+        WeatherConfig(lat=45.7601, lon=4.8299, timezone="UTC").location.lat == 45.7601
+    )
+
+    with mock.patch.object(
+        WeatherBatcher,
+        "_fetch_batch",
+        autospec=True,
+        side_effect=WeatherBatcher._fetch_batch,
+    ) as fetch_batch:
+        weathers = await asyncio.gather(*(config.load(http) for config in configs))
+
+    fetch_batch.assert_called_once()
+    [(_, _, requirements, batch)] = [call.args for call in fetch_batch.call_args_list]
+    assert requirements == WeatherRequirements()
+    assert len(batch) == 2
+    assert all(weather.temperature == 12.6 for weather in weathers)
+
+
+async def test_weather_batching_session(http: aiohttp.ClientSession, monkeypatch):
+    shared = aiohttp.ClientSession()
+
+    @asynccontextmanager
+    async def provider() -> AsyncGenerator[aiohttp.ClientSession]:
+        yield shared
+
+    monkeypatch.setattr(session_module, "_session_provider", provider)
+
+    with mock.patch.object(
+        WeatherBatcher,
+        "_fetch_batch",
+        autospec=True,
+        side_effect=WeatherBatcher._fetch_batch,
+    ) as fetch_batch:
+        await WeatherConfig(lat=48.0, lon=2.0, timezone="Europe/Paris").load(http)
+
+    # Batches are fetched with the session shared by the app
+    [(_, session, _, _)] = [call.args for call in fetch_batch.call_args_list]
+    assert session is shared
+    await shared.close()
+
+
+async def test_weather_requirements(http: aiohttp.ClientSession):
+    config = WeatherConfig(lat=44.8378, lon=-0.5792, timezone="Europe/Paris")
+    recap = WeatherRecap3x2(weather=config)
+    week = WeatherWeek3x1(weather=config)
+
+    with mock.patch.object(
+        WeatherBatcher,
+        "_fetch_batch",
+        autospec=True,
+        side_effect=WeatherBatcher._fetch_batch,
+    ) as fetch_batch:
+        recap_metrics, week_metrics = await asyncio.gather(
+            recap.load_metrics(http),
+            week.load_metrics(http),
+        )
+
+    # Requirements of both widgets are merged in a single query
+    fetch_batch.assert_called_once()
+    [(_, _, requirements, _)] = [call.args for call in fetch_batch.call_args_list]
+    assert requirements == WeatherRequirements(daily_days=7, hourly_days=2)
+
+    assert len(recap_metrics["weather"].daily) == 1
+    assert len(recap_metrics["weather"].hourly) == 2 * 24
+    assert len(week_metrics["weather"].daily) == 7
+    assert week_metrics["weather"].hourly is None
@@ -0,0 +1,108 @@
+import asyncio
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from verdandi.canvas import Canvas
+from verdandi.configuration import RegistryConfiguration
+from verdandi.registry import ResponseRegistry
+
+
+def ready(canvas: Canvas) -> asyncio.Future[Canvas]:
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(canvas)
+    return future
+
+
+async def test_registry_expiration():
+    registry = ResponseRegistry(config=RegistryConfiguration())
+    canvas = Canvas(fingerprint="a", content=b"1234")
+    now = datetime(2025, 7, 1, 11, 0)
+    entry_id = uuid4()
+    registry.set(entry_id, ready(canvas), now)
+
+    assert await registry.get(entry_id, now + timedelta(hours=1)) == canvas
+    assert await registry.get(entry_id, now + timedelta(hours=4)) is None
+    assert await registry.get(uuid4(), now) is None
+
+    stats = registry.stats()
+    assert (stats.entries, stats.size, stats.expirations) == (0, 0, 1)
+    assert (stats.hits, stats.misses) == (1, 2)
+
+
+async def test_registry_bounds():
+    registry = ResponseRegistry(
+        config=RegistryConfiguration(max_entries=3, max_size=10),
+    )
+
+    now = datetime(2025, 7, 1, 11, 0)
+    canvas_small = Canvas(fingerprint="small", content=b"1234")
+    canvas_large = Canvas(fingerprint="large", content=b"12345678")
+    ids = [uuid4() for _ in range(4)]
+
+    # Entries sharing a canvas are accounted for once in the size
+    for i, entry_id in enumerate(ids[:3]):
+        registry.set(entry_id, ready(canvas_small), now + timedelta(minutes=i))
+
+    assert registry.stats().size == 4
+
+    # The oldest entries are evicted first
+    registry.set(ids[3], ready(canvas_small), now + timedelta(minutes=3))
+    assert await registry.get(ids[0], now) is None
+    assert await registry.get(ids[1], now) == canvas_small
+
+    large_id = uuid4()
+    registry.set(large_id, ready(canvas_large), now + timedelta(minutes=4))
+    assert await registry.get(large_id, now) == canvas_large
+    assert registry.stats().size == 8
+    assert registry.stats().evictions == 4
+
+
+async def test_registry_pending():
+    registry = ResponseRegistry(config=RegistryConfiguration())
+    canvas = Canvas(fingerprint="a", content=b"1234")
+    now = datetime.now()
+    entry_id = uuid4()
+
+    async def generate() -> Canvas:
+        await asyncio.sleep(0.01)
+        return canvas
+
+    registry.set(entry_id, asyncio.create_task(generate()), now)
+    assert registry.stats().pending == 1
+    assert await registry.get(entry_id, now) == canvas
+    assert registry.stats().pending == 0
+    assert registry.stats().entries == 1
+
+
+async def test_registry_pending_cancel():
+    registry = ResponseRegistry(config=RegistryConfiguration())
+    canvas = Canvas(fingerprint="a", content=b"1234")
+    now = datetime.now()
+    entry_id = uuid4()
+
+    async def generate() -> Canvas:
+        await asyncio.sleep(0.01)
+        return canvas
+
+    registry.set(entry_id, asyncio.create_task(generate()), now)
+    cancelled = asyncio.create_task(registry.get(entry_id, now))
+    other = asyncio.create_task(registry.get(entry_id, now))
+    await asyncio.sleep(0)
+
+    # Other holders of the entry still get the response
+    cancelled.cancel()
+    assert await other == canvas
+    assert await registry.get(entry_id, now) == canvas
+
+
+async def test_registry_set_again():
+    registry = ResponseRegistry(config=RegistryConfiguration())
+    now = datetime(2025, 7, 1, 12, 0)
+    entry_id = uuid4()
+    canvas = Canvas(fingerprint="canvas", content=b"0")
+
+    # A pre-rendered entry stays retrievable while it is handed out
+    registry.set(entry_id, ready(canvas), now)
+    registry.set(entry_id, ready(canvas), now + timedelta(hours=3, minutes=5))
+    assert await registry.get(entry_id, now + timedelta(hours=4)) == canvas
+    assert await registry.get(entry_id, now + timedelta(hours=7)) is None
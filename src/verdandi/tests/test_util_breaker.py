@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from verdandi.util.breaker import BreakerState, CircuitBreaker, CircuitOpenError
+
+
+def test_breaker():
+    breaker = CircuitBreaker(
+        "test", failure_threshold=2, reset_timeout=timedelta(minutes=1)
+    )
+    now = datetime(2025, 7, 1, 12, 0)
+
+    breaker.record_failure(now)
+    assert not breaker.check(now)
+    breaker.record_failure(now)
+    assert breaker.state(now) is BreakerState.OPEN
+
+    with pytest.raises(CircuitOpenError):
+        breaker.check(now + timedelta(seconds=30))
+
+    # A single trial call is let through, its failure opens the breaker again
+    now += timedelta(minutes=1)
+    assert breaker.check(now)
+
+    with pytest.raises(CircuitOpenError):
+        breaker.check(now)
+
+    breaker.record_failure(now)
+    assert breaker.state(now + timedelta(seconds=30)) is BreakerState.OPEN
+
+    now += timedelta(minutes=1)
+    breaker.check(now)
+    breaker.record_success()
+    assert breaker.state(now) is BreakerState.CLOSED
@@ -1,9 +1,13 @@
 import asyncio
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
 from datetime import datetime, date, time, timedelta, UTC
 
+import aiohttp
 import pytest
 import time_machine
 
+from verdandi.util import session as session_module
 from verdandi.util.cache import async_time_cache
 
 
@@ -101,3 +105,118 @@ async def test_concurrent_crash():
 
     with time_machine.travel(t3):
         assert await crash_once() == 3
+
+
+async def test_stale_while_revalidate():
+    @async_time_cache(timedelta(hours=1), max_staleness=timedelta(hours=1))
+    async def get_time() -> datetime:
+        await asyncio.sleep(0.01)
+        return datetime.now(UTC).replace(second=0, microsecond=0)
+
+    d = date(2025, 7, 1)
+    t1 = datetime.combine(d, time(12, 0), tzinfo=UTC)
+    t2 = datetime.combine(d, time(13, 20), tzinfo=UTC)
+    t3 = datetime.combine(d, time(15, 30), tzinfo=UTC)
+
+    with time_machine.travel(t1):
+        assert await get_time() == t1
+
+    # The stale value is served while it is refreshed in background
+    with time_machine.travel(t2, tick=False):
+        assert await get_time() == t1
+        await asyncio.gather(*get_time.cache_refresh_tasks.values())
+        assert await get_time() == t2
+
+    # The value is too stale to be served
+    with time_machine.travel(t3):
+        assert await get_time() == t3
+
+
+async def test_refresh_session(monkeypatch):
+    @async_time_cache(timedelta(hours=1), refresh_ahead=0.5)
+    async def get_session(http: aiohttp.ClientSession) -> aiohttp.ClientSession:
+        return http
+
+    async with aiohttp.ClientSession() as shared:
+
+        @asynccontextmanager
+        async def provider() -> AsyncGenerator[aiohttp.ClientSession]:
+            yield shared
+
+        monkeypatch.setattr(session_module, "_session_provider", provider)
+        d = date(2025, 7, 1)
+
+        with time_machine.travel(datetime.combine(d, time(12, 0), tzinfo=UTC)):
+            async with aiohttp.ClientSession() as http:
+                assert await get_session(http) is http
+
+        # The session of the first caller is closed, refreshes use the shared
+        # one instead
+        with time_machine.travel(datetime.combine(d, time(12, 40), tzinfo=UTC)):
+            assert await get_session(http) is http
+            await asyncio.gather(*get_session.cache_refresh_tasks.values())
+            assert await get_session(http) is shared
+
+
+async def test_refresh_ahead():
+    @async_time_cache(timedelta(hours=1), refresh_ahead=0.5)
+    async def crash_twice() -> int:
+        num_calls = getattr(crash_twice, "num_calls", 0) + 1
+        setattr(crash_twice, "num_calls", num_calls)
+        await asyncio.sleep(0.01)
+
+        if num_calls in (2, 3):
+            raise RuntimeError("It will crash twice")
+
+        return num_calls
+
+    d = date(2025, 7, 1)
+    t1 = datetime.combine(d, time(12, 0), tzinfo=UTC)
+    t2 = datetime.combine(d, time(12, 20), tzinfo=UTC)
+    t3 = datetime.combine(d, time(12, 40), tzinfo=UTC)
+    t4 = datetime.combine(d, time(12, 50), tzinfo=UTC)
+
+    with time_machine.travel(t1):
+        assert await crash_twice() == 1
+
+    with time_machine.travel(t2):
+        assert await crash_twice() == 1
+        assert not crash_twice.cache_refresh_tasks
+
+    # Failed refreshes keep the previous value
+    with time_machine.travel(t3):
+        assert await crash_twice() == 1
+        await asyncio.gather(*crash_twice.cache_refresh_tasks.values())
+        assert await crash_twice() == 1
+        await asyncio.gather(*crash_twice.cache_refresh_tasks.values())
+
+    with time_machine.travel(t4):
+        assert await crash_twice() == 1
+        await asyncio.gather(*crash_twice.cache_refresh_tasks.values())
+        assert await crash_twice() == 4
+
+
+async def test_cache_bounds():
+    @async_time_cache(timedelta(hours=1), max_entries=2)
+    async def square(x: int) -> int:
+        return x * x
+
+    d = date(2025, 7, 1)
+    t1 = datetime.combine(d, time(12, 0), tzinfo=UTC)
+    t2 = datetime.combine(d, time(12, 30), tzinfo=UTC)
+    t3 = datetime.combine(d, time(13, 15), tzinfo=UTC)
+
+    with time_machine.travel(t1):
+        assert await square(1) == 1
+        assert await square(2) == 4
+
+    # The least recently used value is evicted
+    with time_machine.travel(t2):
+        assert await square(1) == 1
+        assert await square(3) == 9
+        assert square.cache_info() == (1, 3, 1, 0, 2)
+
+    # Only the value computed at t1 expired
+    with time_machine.travel(t3):
+        assert await square(3) == 9
+        assert square.cache_info() == (2, 3, 1, 1, 1)
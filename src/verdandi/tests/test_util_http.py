@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import aiohttp
+import pytest
+from aioresponses import CallbackResult, aioresponses
+
+from verdandi.util.breaker import BreakerState, CircuitOpenError, get_breaker
+from verdandi.util.http import conditional_get, parse_json
+
+
+async def test_conditional_get():
+    url = "https://example.com/data.json"
+    requests_headers = []
+    parsed_bodies = []
+
+    def callback(url, headers, **kwargs) -> CallbackResult:
+        requests_headers.append(headers)
+
+        if headers.get("If-None-Match") == '"v1"':
+            return CallbackResult(status=304)
+
+        return CallbackResult(payload={"value": 1}, headers={"ETag": '"v1"'})
+
+    async def parse(body: bytes) -> dict:
+        parsed_bodies.append(body)
+        return await parse_json(body)
+
+    async with aiohttp.ClientSession() as http:
+        with aioresponses() as mock:
+            mock.get(url, callback=callback, repeat=True)
+            assert await conditional_get(http, url, parse) == {"value": 1}
+            assert await conditional_get(http, url, parse) == {"value": 1}
+
+            # Variants are fetched and parsed separately
+            assert await conditional_get(http, url, parse, variant=2) == {"value": 1}
+
+    assert [headers.get("If-None-Match") for headers in requests_headers] == [
+        None,
+        '"v1"',
+        None,
+    ]
+
+    assert len(parsed_bodies) == 2
+
+
+async def test_circuit_breaker():
+    url = "https://failing.example.com/data.json"
+
+    async with aiohttp.ClientSession() as http:
+        with aioresponses() as mock:
+            mock.get(url, status=503, repeat=True)
+
+            for _ in range(3):
+                with pytest.raises(aiohttp.ClientResponseError):
+                    await conditional_get(http, url, parse_json)
+
+            # The host is not requested anymore
+            with pytest.raises(CircuitOpenError):
+                await conditional_get(http, url, parse_json)
+
+            assert sum(len(calls) for calls in mock.requests.values()) == 3
+
+    get_breaker("failing.example.com").record_success()
+
+
+async def test_circuit_breaker_trial():
+    url = "https://slow.example.com/data.json"
+    breaker = get_breaker("slow.example.com")
+
+    async def callback(url, **kwargs) -> CallbackResult:
+        await asyncio.sleep(0.05)
+        return CallbackResult(payload={})
+
+    async with aiohttp.ClientSession() as http:
+        with aioresponses() as mock:
+            mock.get(url, callback=callback, repeat=True)
+            other = asyncio.create_task(conditional_get(http, url, parse_json))
+            await asyncio.sleep(0)
+
+            # The breaker opens while a call is in flight, then lets a trial
+            # call through
+            for _ in range(3):
+                breaker.record_failure(datetime.now() - timedelta(minutes=2))
+
+            trial = asyncio.create_task(conditional_get(http, url, parse_json))
+            await asyncio.sleep(0)
+            assert breaker.trial_running
+
+            # Cancelling the other call does not let a second trial through
+            other.cancel()
+            await asyncio.gather(other, return_exceptions=True)
+
+            with pytest.raises(CircuitOpenError):
+                await conditional_get(http, url, parse_json)
+
+            await trial
+
+    assert breaker.state(datetime.now()) is BreakerState.CLOSED
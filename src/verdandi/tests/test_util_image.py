@@ -0,0 +1,67 @@
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from verdandi.util.color import CB, CD, CL, CW
+from verdandi.util.image import (
+    CompressionStrategy,
+    image_to_bytes,
+    indexed_to_bitplanes,
+    indexed_to_bmp,
+    invalid_colors,
+    to_indexed,
+)
+
+
+def test_image_to_bytes():
+    img = Image.new("L", (800, 480), CW)
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 99, 99), fill=CB)
+    draw.rectangle((100, 0, 199, 99), fill=CD)
+    draw.rectangle((200, 0, 299, 99), fill=CL)
+    assert invalid_colors(img) == set()
+
+    for strategy in CompressionStrategy:
+        decoded = Image.open(BytesIO(image_to_bytes(img, 9, strategy)))
+        assert decoded.mode == "P"
+        assert decoded.convert("L").tobytes() == img.tobytes()
+
+
+def test_image_to_bytes_nearest():
+    img = Image.new("L", (4, 1))
+    img.putdata([10, 80, 200, 250])
+    assert invalid_colors(img) == {10, 80, 200, 250}
+
+    decoded = Image.open(BytesIO(image_to_bytes(img))).convert("L")
+    assert decoded.tobytes() == bytes([CB, CD, CL, CW])
+
+
+def test_bitplanes():
+    img = Image.new("L", (9, 2), CW)
+    img.putdata([CB, CD, CL, CW, CB, CD, CL, CW, CB] + [CW] * 9)
+    indexed = to_indexed(img)
+
+    # Most significant bits of palette indices come first
+    assert indexed_to_bitplanes(indexed, 1) == bytes([0b00110011, 0, 0xFF, 0x80])
+    assert indexed_to_bitplanes(indexed, 2) == bytes(
+        [0b00110011, 0, 0xFF, 0x80, 0b01010101, 0, 0xFF, 0x80]
+    )
+
+
+def test_bmp():
+    img = Image.new("L", (13, 3), CW)
+    img.putpixel((0, 0), CB)
+    indexed = to_indexed(img)
+
+    decoded = Image.open(BytesIO(indexed_to_bmp(indexed, 1)))
+    assert decoded.size == (13, 3)
+    assert decoded.convert("L").tobytes() == img.tobytes()
+
+    # Rows of 2-bit pixels are padded to 4 bytes and stored bottom-up
+    content = indexed_to_bmp(indexed, 2)
+    offset = int.from_bytes(content[10:14], "little")
+    assert content[28] == 2
+    assert len(content) == offset + 3 * 4
+    assert content[offset:] == bytes(
+        [0xFF, 0xFF, 0xFF, 0xC0] * 2 + [0x3F, 0xFF, 0xFF, 0xC0]
+    )
@@ -0,0 +1,30 @@
+from verdandi.util.prometheus import REGISTRY, Counter, Histogram
+
+
+def test_histogram():
+    histogram = Histogram("test_seconds", "Test.", labels=("step",), buckets=(1, 5))
+    REGISTRY.remove(histogram)
+
+    for value in (0.5, 1, 3, 8):
+        histogram.observe(value, step="a")
+
+    assert histogram.expose().splitlines() == [
+        "# HELP test_seconds Test.",
+        "# TYPE test_seconds histogram",
+        'test_seconds_bucket{step="a",le="1.0"} 2',
+        'test_seconds_bucket{step="a",le="5.0"} 3',
+        'test_seconds_bucket{step="a",le="+Inf"} 4',
+        'test_seconds_sum{step="a"} 12.5',
+        'test_seconds_count{step="a"} 4',
+    ]
+
+
+def test_counter():
+    counter = Counter("test_calls", "Test.", labels=("function",))
+    REGISTRY.remove(counter)
+    counter.inc(function='say "hi"')
+    counter.inc(2, function='say "hi"')
+    assert (
+        counter.expose().splitlines()[-1]
+        == 'test_calls_total{function="say \\"hi\\""} 3.0'
+    )
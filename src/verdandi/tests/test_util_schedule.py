@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import yaml
+
+from verdandi.configuration import ApiConfiguration
+from verdandi.tests.conftest import FIXTURES_PATH
+from verdandi.util.schedule import WhenPredicate
+
+TZ = ZoneInfo("Europe/Paris")
+HORIZON = timedelta(days=7)
+
+
+def test_predicate():
+    predicate = WhenPredicate("now.hour >= 18 and now['weekday'] < 5")
+    assert predicate.fields == ("weekday", "hour")
+
+    assert predicate(datetime(2025, 11, 14, 18, 30, tzinfo=TZ))
+    assert not predicate(datetime(2025, 11, 15, 18, 30, tzinfo=TZ))
+    assert not predicate(datetime(2025, 11, 14, 17, 59, tzinfo=TZ))
+
+    # Results are memoized by fields the expression depends on
+    assert len(predicate.results) == 3
+    assert predicate(datetime(2025, 11, 14, 19, 0, tzinfo=TZ))
+    assert len(predicate.results) == 4
+
+
+def test_predicate_next_change():
+    predicate = WhenPredicate("now.hour >= 18 and now.minute < 30")
+    now = datetime(2025, 11, 14, 16, 12, tzinfo=TZ)
+    change = datetime(2025, 11, 14, 18, 0, tzinfo=TZ)
+    assert predicate.next_change(now, HORIZON) == change
+    assert predicate.next_change(change, HORIZON) == change.replace(minute=30)
+
+    assert WhenPredicate("True").next_change(now, HORIZON) is None
+
+
+def test_next_update_appearing_widget():
+    with open(FIXTURES_PATH / "test-config.yaml") as file:
+        data = yaml.safe_load(file)
+
+    now = datetime(2025, 11, 14, 16, 12, 20, tzinfo=TZ)
+    assert ApiConfiguration(**data).next_update(now) == now.replace(
+        hour=17, minute=0, second=0
+    )
+
+    # The calendar appears before any displayed widget needs an update
+    data["widgets"][-1]["when"] = "now.hour == 16 and now.minute >= 30"
+    configuration = ApiConfiguration(**data)
+    assert configuration.next_update(now) == now.replace(minute=30, second=0)
+    assert len(configuration.displayed_widgets(now)) == len(data["widgets"]) - 1
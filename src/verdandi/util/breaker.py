@@ -0,0 +1,129 @@
+import logging
+from datetime import datetime, timedelta
+from enum import Enum
+
+from verdandi.util.prometheus import Counter, Gauge
+
+logger = logging.getLogger(__name__)
+
+BREAKER_STATE = Gauge(
+    "verdandi_circuit_breaker_state",
+    "State of circuit breakers (0: closed, 1: half-open, 2: open).",
+    labels=("upstream",),
+)
+
+BREAKER_REJECTIONS = Counter(
+    "verdandi_circuit_breaker_rejections",
+    "Calls short-circuited by an open circuit breaker.",
+    labels=("upstream",),
+)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an upstream whose circuit breaker is open.
+    """
+
+    def __init__(self, upstream: str, retry_at: datetime):
+        super().__init__(f"Circuit breaker of {upstream} is open")
+        self.upstream = upstream
+        self.retry_at = retry_at
+
+
+class BreakerState(Enum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitBreaker:
+    """
+    Stop calling an upstream after `failure_threshold` consecutive failures.
+    Once `reset_timeout` elapsed, a single trial call is let through: the
+    breaker closes if it succeeds, and opens again otherwise.
+    """
+
+    def __init__(
+        self,
+        upstream: str,
+        failure_threshold: int = 3,
+        reset_timeout: timedelta = timedelta(minutes=1),
+    ):
+        assert failure_threshold > 0
+        self.upstream = upstream
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: datetime | None = None
+        self.trial_running = False
+        BREAKER_STATE.set(BreakerState.CLOSED.value, upstream=upstream)
+
+    def state(self, now: datetime) -> BreakerState:
+        if self.opened_at is None:
+            return BreakerState.CLOSED
+
+        if now < self.opened_at + self.reset_timeout or self.trial_running:
+            return BreakerState.OPEN
+
+        return BreakerState.HALF_OPEN
+
+    def check(self, now: datetime) -> bool:
+        """
+        Raise CircuitOpenError if the upstream must not be called at `now`,
+        return whether the call is the trial one.
+        """
+        match self.state(now):
+            case BreakerState.CLOSED:
+                return False
+            case BreakerState.HALF_OPEN:
+                self.trial_running = True
+                BREAKER_STATE.set(BreakerState.HALF_OPEN.value, upstream=self.upstream)
+                return True
+            case BreakerState.OPEN:
+                assert self.opened_at is not None
+                BREAKER_REJECTIONS.inc(upstream=self.upstream)
+
+                raise CircuitOpenError(
+                    self.upstream,
+                    self.opened_at + self.reset_timeout,
+                )
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Circuit breaker of %s closed", self.upstream)
+
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        BREAKER_STATE.set(BreakerState.CLOSED.value, upstream=self.upstream)
+
+    def cancel_trial(self):
+        """
+        Let another call try the upstream if the trial call was interrupted.
+        """
+        self.trial_running = False
+
+    def record_failure(self, now: datetime):
+        self.failures += 1
+
+        if self.trial_running or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("Circuit breaker of %s opened", self.upstream)
+
+            self.opened_at = now
+            self.trial_running = False
+            BREAKER_STATE.set(BreakerState.OPEN.value, upstream=self.upstream)
+
+
+_breakers: dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(upstream: str) -> CircuitBreaker:
+    """
+    Get the circuit breaker shared by all calls to an upstream.
+    """
+    if (res := _breakers.get(upstream)) is None:
+        res = CircuitBreaker(upstream)
+        _breakers[upstream] = res
+
+    return res
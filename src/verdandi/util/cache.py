@@ -1,11 +1,17 @@
+import asyncio
 import functools
+import heapq
+import itertools
 import logging
 from asyncio import Event
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from typing import Any, Awaitable, Callable, Coroutine
+from typing import Any, Awaitable, Callable, Coroutine, NamedTuple
 
 import aiohttp
-from pydantic import BaseModel
+
+from verdandi.util.prometheus import Counter
+from verdandi.util.session import background_session
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -18,47 +24,210 @@ KWD_MARK = object()
 IGNORED_TYPES = [aiohttp.ClientSession]
 
 
-class CacheSlot[T](BaseModel):
+CACHE_HITS = Counter(
+    "verdandi_cache_hits",
+    "Calls of cached functions served from cache.",
+    labels=("function",),
+)
+
+CACHE_MISSES = Counter(
+    "verdandi_cache_misses",
+    "Calls of cached functions which had to be computed.",
+    labels=("function",),
+)
+
+CACHE_REFRESHES = Counter(
+    "verdandi_cache_refreshes",
+    "Cached values refreshed in background.",
+    labels=("function",),
+)
+
+CACHE_EXPIRATIONS = Counter(
+    "verdandi_cache_expirations",
+    "Cached values removed after their expiration.",
+    labels=("function",),
+)
+
+CACHE_EVICTIONS = Counter(
+    "verdandi_cache_evictions",
+    "Cached values removed to bound the size of the cache.",
+    labels=("function",),
+)
+
+
+class CacheSlot[T](NamedTuple):
     expiration: datetime
     value: T
 
 
+class CacheStats(NamedTuple):
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    size: int
+
+
+class LruStore[K, V]:
+    """
+    A mapping holding at most `max_entries` items, the least recently used
+    items are evicted first.
+    """
+
+    def __init__(
+        self,
+        max_entries: int,
+        on_evict: Callable[[K, V], None] | None = None,
+    ):
+        assert max_entries > 0
+        self.max_entries = max_entries
+        self.on_evict = on_evict
+        self.entries: OrderedDict[K, V] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.entries
+
+    def get(self, key: K) -> V | None:
+        value = self.entries.get(key)
+
+        if value is not None:
+            self.entries.move_to_end(key)
+
+        return value
+
+    def set(self, key: K, value: V):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            evicted_key, evicted_value = self.entries.popitem(last=False)
+
+            if self.on_evict is not None:
+                self.on_evict(evicted_key, evicted_value)
+
+
+class TimeCacheStore:
+    """
+    Slots of a time cache, indexed by their key. Slots are removed once they
+    are too old to be served, or when the store is full (least recently used
+    first).
+    """
+
+    def __init__(self, name: str, max_entries: int, stale_window: timedelta):
+        assert max_entries > 0
+        self.name = name
+        self.max_entries = max_entries
+        self.stale_window = stale_window
+        self.slots: OrderedDict[Any, CacheSlot] = OrderedDict()
+
+        # Heap of the times slots can be removed at, outdated items (for slots
+        # that were replaced or evicted) are skipped when they are popped
+        self.deadlines: list[tuple[datetime, int, Any]] = []
+        self.sequence = itertools.count()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def stats(self) -> CacheStats:
+        return CacheStats(
+            hits=self.hits,
+            misses=self.misses,
+            evictions=self.evictions,
+            expirations=self.expirations,
+            size=len(self.slots),
+        )
+
+    def hit(self):
+        self.hits += 1
+        CACHE_HITS.inc(function=self.name)
+
+    def miss(self):
+        self.misses += 1
+        CACHE_MISSES.inc(function=self.name)
+
+    def get(self, key: Any) -> CacheSlot | None:
+        slot = self.slots.get(key)
+
+        if slot is not None:
+            self.slots.move_to_end(key)
+
+        return slot
+
+    def set(self, key: Any, slot: CacheSlot):
+        self.slots[key] = slot
+        self.slots.move_to_end(key)
+        deadline = slot.expiration + self.stale_window
+        heapq.heappush(self.deadlines, (deadline, next(self.sequence), key))
+
+        if len(self.slots) > self.max_entries:
+            self.slots.popitem(last=False)
+            self.evictions += 1
+            CACHE_EVICTIONS.inc(function=self.name)
+
+    def purge(self, now: datetime):
+        """
+        Remove all slots which are too old to be served at `now`.
+        """
+        expired = 0
+
+        while self.deadlines and self.deadlines[0][0] < now:
+            deadline, _, key = heapq.heappop(self.deadlines)
+            slot = self.slots.get(key)
+
+            if slot is not None and slot.expiration + self.stale_window == deadline:
+                del self.slots[key]
+                expired += 1
+
+        if expired:
+            self.expirations += expired
+            CACHE_EXPIRATIONS.inc(expired, function=self.name)
+
+
 def async_time_cache[**P1, R1](
     persistance: timedelta,
+    refresh_ahead: float | None = None,
+    max_staleness: timedelta | None = None,
+    max_entries: int = 256,
 ) -> Callable[[Callable[P1, Awaitable[R1]]], Callable[P1, Coroutine[None, None, R1]]]:
     """
     Ensure the function is not executed twice in a given period of time.
+
+    If `refresh_ahead` is set, the value is refreshed in background once this
+    fraction of its persistance has elapsed. If `max_staleness` is set, an
+    expired value is still served for this duration while it is refreshed in
+    background, only later calls wait for a new value.
+
+    At most `max_entries` values are kept, the least recently used ones are
+    evicted first. Statistics are available through `cache_info()`.
     """
+    assert refresh_ahead is None or 0.0 < refresh_ahead < 1.0
+    stale_window = max_staleness or timedelta(0)
+    ignored_types = tuple(IGNORED_TYPES)
 
     def decorator[**P2, R2](
         func: Callable[P2, Awaitable[R2]],
     ) -> Callable[P2, Coroutine[None, None, R2]]:
-        @functools.wraps(func)
-        async def wrapper(*args: P2.args, **kwargs: P2.kwargs) -> R2:
-            cache_params = (*args, KWD_MARK, *sorted(kwargs.items()))
-
-            cache_key = tuple(
-                param
-                for param in cache_params
-                if not any(
-                    isinstance(param, ignored_type) for ignored_type in IGNORED_TYPES
-                )
-            )
-
-            now = datetime.now()
-
-            # Extract stores from wrapped object
-            cache_store: dict[Any, CacheSlot] = wrapper.cache_store  # ty: ignore[unresolved-attribute]
+        async def compute(
+            cache_key: Any,
+            outdated: CacheSlot | None,
+            *args: P2.args,
+            **kwargs: P2.kwargs,
+        ) -> R2:
+            """
+            Compute the value for a key if it is missing, expired or still the
+            `outdated` slot, concurent calls for the same key wait for the
+            first one to finish.
+            """
             cache_compute_events: dict[Any, Event] = wrapper.cache_compute_events  # ty: ignore[unresolved-attribute]
 
-            # Cleanup all expired keys
-            expired_keys = [
-                key for key, slot in cache_store.items() if slot.expiration < now
-            ]
-
-            for key in expired_keys:
-                del cache_store[key]
-
             # If a compute event has been created for this key, wait for the
             # computation to finish. We are not ensured that a result will be
             # added to the cache store because the computation may have raised
@@ -70,15 +239,23 @@ def async_time_cache[**P1, R1](
             # happen)
             compute_event = Event()
             cache_compute_events[cache_key] = compute_event
+            now = datetime.now()
 
             try:
                 # Fetch and update cache
                 cache_slot: CacheSlot | None = cache_store.get(cache_key)
 
-                if cache_slot is None or cache_slot.expiration < now:
+                if (
+                    cache_slot is None
+                    or cache_slot is outdated
+                    or cache_slot.expiration < now
+                ):
+                    cache_store.miss()
                     value = await func(*args, **kwargs)
-                    cache_slot = CacheSlot(expiration=now + persistance, value=value)
-                    cache_store[cache_key] = cache_slot
+                    cache_slot = CacheSlot(now + persistance, value)
+                    cache_store.set(cache_key, cache_slot)
+                else:
+                    cache_store.hit()
 
                 return cache_slot.value
             finally:
@@ -86,8 +263,103 @@ def async_time_cache[**P1, R1](
                 compute_event.set()
                 del cache_compute_events[cache_key]
 
-        wrapper.cache_store = {}  # ty: ignore[unresolved-attribute]
+        async def refresh(
+            cache_key: Any,
+            outdated: CacheSlot,
+            *args: P2.args,
+            **kwargs: P2.kwargs,
+        ):
+            # Sessions of the caller may be closed by now, they are replaced by
+            # the session shared by the app
+            session = next(
+                (
+                    arg
+                    for arg in (*args, *kwargs.values())
+                    if isinstance(arg, aiohttp.ClientSession)
+                ),
+                None,
+            )
+
+            # On failure, the previous value is kept until it is too stale
+            try:
+                if session is None:
+                    await compute(cache_key, outdated, *args, **kwargs)
+                    return
+
+                async with background_session(session) as http:
+
+                    def resolve(arg: Any) -> Any:
+                        if isinstance(arg, aiohttp.ClientSession):
+                            return http
+
+                        return arg
+
+                    await compute(
+                        cache_key,
+                        outdated,
+                        *map(resolve, args),  # ty: ignore[invalid-argument-type]
+                        **{name: resolve(arg) for name, arg in kwargs.items()},  # ty: ignore[invalid-argument-type]
+                    )
+            except Exception:
+                logger.exception("Could not refresh %s", func.__qualname__)
+
+        def schedule_refresh(
+            cache_key: Any,
+            outdated: CacheSlot,
+            *args: P2.args,
+            **kwargs: P2.kwargs,
+        ):
+            refresh_tasks: dict[Any, asyncio.Task] = wrapper.cache_refresh_tasks  # ty: ignore[unresolved-attribute]
+
+            if cache_key in refresh_tasks:
+                return
+
+            CACHE_REFRESHES.inc(function=func.__qualname__)
+            task = asyncio.create_task(refresh(cache_key, outdated, *args, **kwargs))
+            refresh_tasks[cache_key] = task
+            task.add_done_callback(lambda _: refresh_tasks.pop(cache_key, None))
+
+        @functools.wraps(func)
+        async def wrapper(*args: P2.args, **kwargs: P2.kwargs) -> R2:
+            cache_key = tuple(arg for arg in args if not isinstance(arg, ignored_types))
+
+            if kwargs:
+                cache_key += (
+                    KWD_MARK,
+                    *(
+                        (name, arg)
+                        for name, arg in sorted(kwargs.items())
+                        if not isinstance(arg, ignored_types)
+                    ),
+                )
+
+            now = datetime.now()
+
+            # Cleanup all keys which are too old to be served
+            cache_store.purge(now)
+
+            # Serve the cached value if it can be, refreshing it if required
+            cache_slot: CacheSlot | None = cache_store.get(cache_key)
+
+            if cache_slot is not None and now <= cache_slot.expiration + stale_window:
+                refresh_at = cache_slot.expiration
+
+                if refresh_ahead is not None:
+                    refresh_at -= persistance * (1.0 - refresh_ahead)
+
+                if now > refresh_at:
+                    schedule_refresh(cache_key, cache_slot, *args, **kwargs)
+
+                cache_store.hit()
+                return cache_slot.value
+
+            return await compute(cache_key, None, *args, **kwargs)
+
+        cache_store = TimeCacheStore(func.__qualname__, max_entries, stale_window)
+        wrapper.cache_store = cache_store  # ty: ignore[unresolved-attribute]
+        wrapper.cache_info = cache_store.stats  # ty: ignore[unresolved-attribute]
         wrapper.cache_compute_events = {}  # ty: ignore[unresolved-attribute]
+        wrapper.cache_refresh_tasks = {}  # ty: ignore[unresolved-attribute]
         return wrapper
 
     return decorator
@@ -50,3 +50,13 @@ def next_time_cadenced(now: datetime, interval: timedelta) -> datetime:
         return date_start + timedelta(days=1)
 
     return curr
+
+
+def prev_time_cadenced(now: datetime, interval: timedelta) -> datetime:
+    """
+    Split the days into intervals of fixed time and return the start of the
+    current interval.
+    """
+    date_start = now.replace(hour=0, minute=0, second=0, microsecond=0)
+    assert interval.total_seconds() > 0.0
+    return date_start + ((now - date_start) // interval) * interval
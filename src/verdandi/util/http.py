@@ -0,0 +1,139 @@
+import json
+from datetime import datetime
+from collections.abc import Awaitable, Callable, Hashable
+from typing import Any
+
+import aiohttp
+from pydantic import BaseModel
+from yarl import URL
+
+from verdandi.util.breaker import get_breaker
+from verdandi.util.cache import LruStore
+from verdandi.util.prometheus import Counter
+
+NOT_MODIFIED_RESPONSES = Counter(
+    "verdandi_http_not_modified",
+    "Conditional requests answered with 304 Not Modified.",
+    labels=("host",),
+)
+
+
+class HttpPoolStats(BaseModel):
+    """
+    Usage of the connection pool of an HTTP session.
+    """
+
+    limit: int
+    limit_per_host: int
+    acquired: int
+    acquired_per_host: dict[str, int]
+    idle: int
+
+    @classmethod
+    def from_session(cls, http: aiohttp.ClientSession) -> "HttpPoolStats":
+        connector = http.connector
+        assert connector is not None
+
+        # Pool usage is not part of aiohttp's public API
+        return cls(
+            limit=connector.limit,
+            limit_per_host=connector.limit_per_host,
+            acquired=len(connector._acquired),
+            acquired_per_host={
+                f"{key.host}:{key.port}": len(conns)
+                for key, conns in connector._acquired_per_host.items()
+            },
+            idle=sum(len(conns) for conns in connector._conns.values()),
+        )
+
+
+class ValidatedContent(BaseModel, arbitrary_types_allowed=True):
+    """
+    Parsed content of a response, along with the validators it can be
+    requested again with.
+    """
+
+    etag: str | None
+    last_modified: str | None
+    parsed: Any
+
+
+# Last validated content of requests, indexed by URL, parameters and variant
+_validated_contents: LruStore[Hashable, ValidatedContent] = LruStore(128)
+
+
+async def parse_json(body: bytes) -> Any:
+    return json.loads(body)
+
+
+async def parse_raw(body: bytes) -> bytes:
+    return body
+
+
+async def conditional_get[T](
+    http: aiohttp.ClientSession,
+    url: str,
+    parse: Callable[[bytes], Awaitable[T]],
+    params: dict[str, Any] | None = None,
+    variant: Hashable = None,
+) -> T:
+    """
+    Fetch and parse a resource, sending the validators of its last response.
+    If the server answers that the resource was not modified, the previous
+    parsed content is returned without downloading nor parsing it again.
+
+    Contents parsed in different ways from the same resource must be told
+    apart with a different `variant`.
+
+    Requests go through the circuit breaker of the host, CircuitOpenError is
+    raised without sending the request while the host is failing.
+    """
+    key = (url, tuple(sorted((k, str(v)) for k, v in (params or {}).items())), variant)
+    headers = {}
+
+    if (previous := _validated_contents.get(key)) is not None:
+        if previous.etag is not None:
+            headers["If-None-Match"] = previous.etag
+
+        if previous.last_modified is not None:
+            headers["If-Modified-Since"] = previous.last_modified
+
+    host = URL(url).host or ""
+    breaker = get_breaker(host)
+    is_trial = breaker.check(datetime.now())
+
+    try:
+        async with http.get(url, params=params, headers=headers) as resp:
+            if resp.status == 304 and previous is not None:
+                breaker.record_success()
+                NOT_MODIFIED_RESPONSES.inc(host=host)
+                return previous.parsed
+
+            # Client errors don't tell that the upstream is failing
+            if resp.status < 500:
+                breaker.record_success()
+
+            resp.raise_for_status()
+            body = await resp.read()
+            etag = resp.headers.get("ETag")
+            last_modified = resp.headers.get("Last-Modified")
+    except (aiohttp.ClientError, TimeoutError) as exc:
+        if not isinstance(exc, aiohttp.ClientResponseError) or exc.status >= 500:
+            breaker.record_failure(datetime.now())
+
+        raise
+    except BaseException:
+        if is_trial:
+            breaker.cancel_trial()
+
+        raise
+
+    parsed = await parse(body)
+
+    if etag is not None or last_modified is not None:
+        _validated_contents.set(
+            key,
+            ValidatedContent(etag=etag, last_modified=last_modified, parsed=parsed),
+        )
+
+    return parsed
@@ -1,51 +1,175 @@
 import logging
+import struct
+import zlib
+from enum import Enum
 from io import BytesIO
 
 from PIL import Image
 
 from verdandi.util.color import CW, CB, CL, CD
+from verdandi.util.prometheus import Histogram
+from verdandi.util.tracing import span
 
 
 logger = logging.getLogger(__name__)
 
+ENCODING_SECONDS = Histogram(
+    "verdandi_image_encoding_seconds",
+    "Time spent encoding canvases to PNG.",
+)
 
-def validate_palette(img: Image.Image) -> bool:
-    palette = {CW, CB, CL, CD}
 
-    return all(
-        img.getpixel((x, y)) in palette
-        for x in range(img.size[0])
-        for y in range(img.size[1])
-    )
+PALETTE: tuple[int, ...] = (CB, CD, CL, CW)
+
+# Map each gray level to the index of the nearest color of the palette
+PALETTE_LUT: list[int] = [
+    min(range(len(PALETTE)), key=lambda idx: abs(PALETTE[idx] - level))
+    for level in range(256)
+]
+
+
+class CompressionStrategy(Enum):
+    """
+    Strategy used by zlib to compress PNG data.
+    """
+
+    DEFAULT = "default"
+    FILTERED = "filtered"
+    HUFFMAN_ONLY = "huffman-only"
+    RLE = "rle"
+    FIXED = "fixed"
+
+    @property
+    def zlib_strategy(self) -> int:
+        return {
+            CompressionStrategy.DEFAULT: zlib.Z_DEFAULT_STRATEGY,
+            CompressionStrategy.FILTERED: zlib.Z_FILTERED,
+            CompressionStrategy.HUFFMAN_ONLY: zlib.Z_HUFFMAN_ONLY,
+            CompressionStrategy.RLE: zlib.Z_RLE,
+            CompressionStrategy.FIXED: zlib.Z_FIXED,
+        }[self]
 
 
 def invalid_colors(img: Image.Image) -> set[int]:
-    palette = {CW, CB, CL, CD}
+    assert img.mode == "L"
 
     return {
-        img.getpixel((x, y))
-        for x in range(img.size[0])
-        for y in range(img.size[1])
-        if img.getpixel((x, y)) not in palette
-    }  # ty:ignore[invalid-return-type]
+        level
+        for level, count in enumerate(img.histogram())
+        if count > 0 and level not in PALETTE
+    }
 
 
-def image_to_bytes(img: Image.Image) -> bytes:
+def validate_palette(img: Image.Image) -> bool:
+    return not invalid_colors(img)
+
+
+def to_indexed(img: Image.Image) -> Image.Image:
+    """
+    Convert a grayscale image to the indices of its colors in the palette,
+    pixels outside of the palette are mapped to the nearest color.
+    """
     if not validate_palette(img):
         logger.warning("Found pixels outside of color palette")
 
-    palette = [
-        *(CB, CB, CB),
-        *(CD, CD, CD),
-        *(CL, CL, CL),
-        *(CW, CW, CW),
-    ]
-
-    palette_img = Image.new("P", (1, 1))
-    palette_img.putpalette(palette + [0] * (3 * 256 - len(palette)))
-    img = img.quantize(palette=palette_img)
-
-    buffer = BytesIO()
-    img.save(buffer, "png", bits=2)
-    buffer.seek(0)
-    return buffer.read()
+    indexed = img.point(PALETTE_LUT)
+    indexed = Image.frombuffer("P", img.size, indexed.tobytes(), "raw", "P", 0, 1)
+    indexed.putpalette([channel for color in PALETTE for channel in (color,) * 3])
+    return indexed
+
+
+def image_to_bytes(
+    img: Image.Image,
+    compress_level: int = 6,
+    strategy: CompressionStrategy = CompressionStrategy.DEFAULT,
+) -> bytes:
+    """
+    Encode a grayscale image as a 2-bit PNG.
+    """
+    with ENCODING_SECONDS.time(), span("encode"):
+        buffer = BytesIO()
+
+        to_indexed(img).save(
+            buffer,
+            "png",
+            bits=2,
+            compress_level=compress_level,
+            compress_type=strategy.zlib_strategy,
+        )
+
+        # Canvases hold bytes, which a view of the buffer would be copied to
+        # anyway: the copy is made here, once
+        return buffer.getvalue()
+
+
+def _palette_bits(indexed: Image.Image, bits: int) -> list[int]:
+    """
+    Shifts of the most significant bits of palette indices kept with a depth
+    of `bits`, from the most significant one.
+    """
+    assert indexed.mode == "P"
+    assert bits in (1, 2)
+    return list(range(1, 1 - bits, -1))
+
+
+def indexed_to_bmp(indexed: Image.Image, bits: int) -> bytes:
+    """
+    Encode a palette image as an uncompressed BMP with 1 or 2 bits per pixel,
+    a depth of 1 bit keeps black and dark grey apart from lighter colors.
+    """
+    assert indexed.mode == "P"
+    assert bits in (1, 2)
+    width, height = indexed.size
+
+    if bits == 1:
+        data = indexed.point(lambda idx: idx >> 1).tobytes("raw", "P;1")
+        colors = (CB, CW)
+    else:
+        data = indexed.tobytes("raw", "P;2")
+        colors = PALETTE
+
+    # Rows are stored bottom-up, each padded to a multiple of 4 bytes
+    stride = (width * bits + 7) // 8
+    padding = b"\0" * (-stride % 4)
+
+    pixels = b"".join(
+        data[row * stride : (row + 1) * stride] + padding
+        for row in reversed(range(height))
+    )
+
+    palette = b"".join(struct.pack("<4B", color, color, color, 0) for color in colors)
+    offset = 14 + 40 + len(palette)
+
+    return b"".join(
+        [
+            struct.pack("<2sIHHI", b"BM", offset + len(pixels), 0, 0, offset),
+            struct.pack(
+                "<IiiHHIIiiII",
+                40,
+                width,
+                height,
+                1,
+                bits,
+                0,
+                len(pixels),
+                2835,
+                2835,
+                len(colors),
+                0,
+            ),
+            palette,
+            pixels,
+        ]
+    )
+
+
+def indexed_to_bitplanes(indexed: Image.Image, bits: int) -> bytes:
+    """
+    Encode a palette image as 1 or 2 planes of packed bits, starting with the
+    most significant bit of palette indices. Rows of each plane start on a
+    new byte, with the leftmost pixel in the most significant bit.
+    """
+    return b"".join(
+        indexed.point(lambda idx, shift=shift: (idx >> shift) & 1).tobytes("raw", "P;1")
+        for shift in _palette_bits(indexed, bits)
+    )
@@ -0,0 +1,173 @@
+import bisect
+import functools
+import math
+from collections.abc import Awaitable, Callable, Coroutine, Iterator
+from contextlib import contextmanager
+from time import perf_counter
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS: tuple[float, ...] = (
+    *(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+    *(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    def escape(value: str) -> str:
+        return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+
+    return repr(float(value))
+
+
+class Collector:
+    """
+    A family of samples exposed in Prometheus' text format, identified by a
+    set of labels.
+    """
+
+    kind: str
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        assert labels.keys() == set(self.labels), labels
+        return tuple(labels[label] for label in self.labels)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.documentation}",
+                f"# TYPE {self.name} {self.kind}",
+                *self.samples(),
+            ]
+        )
+
+
+class Counter(Collector):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.values.items():
+            labels = _format_labels(dict(zip(self.labels, key)))
+            yield f"{self.name}_total{labels} {_format_value(value)}"
+
+
+class Gauge(Collector):
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str):
+        self.values[self._key(labels)] = value
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.values.items():
+            labels = _format_labels(dict(zip(self.labels, key)))
+            yield f"{self.name}{labels} {_format_value(value)}"
+
+
+class Histogram(Collector):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = (*sorted(buckets), math.inf)
+
+        # Count of observations per bucket (not cumulated), and their sum
+        self.counts: dict[tuple[str, ...], list[int]] = {}
+        self.sums: dict[tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+
+        if key not in self.counts:
+            self.counts[key] = [0] * len(self.buckets)
+            self.sums[key] = 0.0
+
+        self.counts[key][bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """
+        Observe the duration of the block, in seconds.
+        """
+        start_time = perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start_time, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for key, counts in self.counts.items():
+            labels = dict(zip(self.labels, key))
+            cumulated = 0
+
+            for bound, count in zip(self.buckets, counts):
+                cumulated += count
+                bucket_labels = _format_labels({**labels, "le": _format_value(bound)})
+                yield f"{self.name}_bucket{bucket_labels} {cumulated}"
+
+            yield f"{self.name}_sum{_format_labels(labels)} {self.sums[key]!r}"
+            yield f"{self.name}_count{_format_labels(labels)} {cumulated}"
+
+
+REGISTRY: list[Collector] = []
+
+
+def expose_all() -> str:
+    """
+    Render all registered collectors in Prometheus' text format.
+    """
+    return "".join(collector.expose() + "\n" for collector in REGISTRY)
+
+
+def async_observe_duration[**P1, R1](
+    histogram: Histogram,
+    **labels: str,
+) -> Callable[[Callable[P1, Awaitable[R1]]], Callable[P1, Coroutine[None, None, R1]]]:
+    def decorator[**P2, R2](
+        func: Callable[P2, Awaitable[R2]],
+    ) -> Callable[P2, Coroutine[None, None, R2]]:
+        @functools.wraps(func)
+        async def wrapper(*args: P2.args, **kwargs: P2.kwargs) -> R2:
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,152 @@
+import ast
+import logging
+from collections.abc import Sequence
+from datetime import datetime, timedelta
+from typing import Protocol
+
+from simpleeval import SimpleEval
+
+from verdandi.util.date import prev_time_cadenced
+
+logger = logging.getLogger(__name__)
+
+# Fields of `now` available to predicates, from the coarsest to the finest
+NOW_FIELDS: tuple[str, ...] = ("month", "day", "weekday", "hour", "minute")
+
+# Period over which the value of a field can change
+_FIELD_STEPS: dict[str, timedelta] = {
+    "month": timedelta(days=1),
+    "day": timedelta(days=1),
+    "weekday": timedelta(days=1),
+    "hour": timedelta(hours=1),
+    "minute": timedelta(minutes=1),
+}
+
+
+def _now_fields(now: datetime) -> dict[str, int]:
+    return {
+        "hour": now.hour,
+        "minute": now.minute,
+        "weekday": now.weekday(),
+        "month": now.month,
+        "day": now.day,
+    }
+
+
+def _referenced_fields(tree: ast.AST) -> tuple[str, ...]:
+    """
+    List fields of `now` the expression depends on, all fields are assumed to
+    be used if `now` is referenced in any other way.
+    """
+    fields = set()
+    field_nodes = set()
+
+    for node in ast.walk(tree):
+        match node:
+            case ast.Attribute(value=ast.Name(id="now"), attr=field):
+                fields.add(field)
+                field_nodes.add(id(node.value))
+            case ast.Subscript(value=ast.Name(id="now"), slice=ast.Constant(field)):
+                fields.add(field)
+                field_nodes.add(id(node.value))
+
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "now":
+            if id(node) not in field_nodes:
+                return NOW_FIELDS
+
+    return tuple(field for field in NOW_FIELDS if field in fields)
+
+
+class WhenPredicate:
+    """
+    A `when` expression, parsed once. Its results are memoized for each value
+    of the fields of `now` it depends on.
+    """
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.evaluator = SimpleEval()
+        self.parsed = self.evaluator.parse(expression)
+        self.fields = _referenced_fields(self.parsed)
+        self.step = min((_FIELD_STEPS[f] for f in self.fields), default=None)
+        self.results: dict[tuple[int, ...], bool] = {}
+
+        # Last computed change, which stays valid for any time between the
+        # time it was computed at and its result
+        self.last_change: tuple[datetime, datetime, datetime | None] | None = None
+
+    def __call__(self, now: datetime) -> bool:
+        values = _now_fields(now)
+        key = tuple(values[field] for field in self.fields)
+
+        if (res := self.results.get(key)) is not None:
+            return res
+
+        self.evaluator.names = {"now": values}
+        res = self.evaluator.eval(self.expression, previously_parsed=self.parsed)
+
+        if not isinstance(res, bool):
+            logger.warning("`when` does not evaluate to bool: %s", self.expression)
+
+        self.results[key] = bool(res)
+        return bool(res)
+
+    def next_change(self, now: datetime, horizon: timedelta) -> datetime | None:
+        """
+        Return the next time the predicate changes value, or None if it does
+        not change in the given horizon.
+        """
+        if self.step is None:
+            return None
+
+        if self.last_change is not None:
+            computed_at, valid_until, change = self.last_change
+
+            if computed_at <= now < valid_until:
+                return change
+
+        current = self(now)
+        change = None
+        curr = prev_time_cadenced(now, self.step) + self.step
+
+        while curr <= now + horizon:
+            if self(curr) != current:
+                change = curr
+                break
+
+            curr += self.step
+
+        valid_until = change if change is not None else now + horizon
+        self.last_change = (now, valid_until, change)
+        return change
+
+
+class ScheduledWidget(Protocol):
+    @property
+    def predicate(self) -> WhenPredicate: ...
+
+
+class DisplaySchedule[W: ScheduledWidget]:
+    """
+    Tell which widgets of a configuration are displayed at a given time, and
+    when this set of widgets changes.
+    """
+
+    def __init__(self, widgets: Sequence[W], horizon: timedelta = timedelta(days=7)):
+        self.widgets = widgets
+        self.horizon = horizon
+
+    def displayed_at(self, now: datetime) -> list[W]:
+        return [widget for widget in self.widgets if widget.predicate(now)]
+
+    def next_change(self, now: datetime) -> datetime | None:
+        return min(
+            (
+                change
+                for widget in self.widgets
+                if (change := widget.predicate.next_change(now, self.horizon))
+                is not None
+            ),
+            default=None,
+        )
@@ -0,0 +1,31 @@
+from collections.abc import AsyncGenerator, Callable
+from contextlib import AbstractAsyncContextManager, asynccontextmanager
+
+import aiohttp
+
+type SessionProvider = Callable[[], AbstractAsyncContextManager[aiohttp.ClientSession]]
+
+# Provider of the session shared by the app, set once the app state is created
+_session_provider: SessionProvider | None = None
+
+
+def set_session_provider(provider: SessionProvider | None):
+    global _session_provider
+    _session_provider = provider
+
+
+@asynccontextmanager
+async def background_session(
+    fallback: aiohttp.ClientSession,
+) -> AsyncGenerator[aiohttp.ClientSession]:
+    """
+    Yield the session shared by the app for work which may outlive the caller
+    it was started by, whose session may be closed meanwhile. The `fallback`
+    session is used if there is no shared session (eg. in scripts).
+    """
+    if _session_provider is None:
+        yield fallback
+        return
+
+    async with _session_provider() as http:
+        yield http
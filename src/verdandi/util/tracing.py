@@ -0,0 +1,185 @@
+import asyncio
+import functools
+import json
+import logging
+import secrets
+from collections.abc import Awaitable, Callable, Coroutine, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from time import time_ns
+
+from pydantic import BaseModel, Field
+
+logger = logging.getLogger(__name__)
+
+
+class Span(BaseModel):
+    """
+    A timed stage of a trace, following OpenTelemetry's span model.
+    """
+
+    name: str
+    span_id: str = Field(default_factory=lambda: secrets.token_hex(8))
+    parent_span_id: str | None = None
+    start_time: int = Field(default_factory=time_ns)
+    end_time: int | None = None
+    attributes: dict[str, str] = Field(default_factory=dict)
+
+    @property
+    def duration_ms(self) -> float:
+        assert self.end_time is not None
+        return (self.end_time - self.start_time) / 1_000_000
+
+    def to_otlp(self, trace_id: str) -> dict:
+        res = {
+            "traceId": trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": 1,
+            "startTimeUnixNano": str(self.start_time),
+            "endTimeUnixNano": str(self.end_time),
+            "attributes": [
+                {"key": key, "value": {"stringValue": value}}
+                for key, value in self.attributes.items()
+            ],
+        }
+
+        if self.parent_span_id is not None:
+            res["parentSpanId"] = self.parent_span_id
+
+        return res
+
+
+class Trace(BaseModel):
+    """
+    Spans recorded while generating a canvas.
+    """
+
+    trace_id: str = Field(default_factory=lambda: secrets.token_hex(16))
+    spans: list[Span] = Field(default_factory=list)
+
+    def server_timing(self) -> str:
+        """
+        Format the duration of finished spans as a Server-Timing header, spans
+        with the same name and widget are summed up.
+        """
+        durations: dict[str, float] = {}
+
+        for span in self.spans:
+            if span.end_time is None:
+                continue
+
+            metric = span.name
+
+            if (widget := span.attributes.get("widget")) is not None:
+                metric += f".{widget}"
+
+            durations[metric] = durations.get(metric, 0.0) + span.duration_ms
+
+        return ", ".join(
+            f"{metric};dur={duration:.1f}" for metric, duration in durations.items()
+        )
+
+    def to_otlp(self) -> dict:
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {
+                        "attributes": [
+                            {
+                                "key": "service.name",
+                                "value": {"stringValue": "verdandi"},
+                            }
+                        ]
+                    },
+                    "scopeSpans": [
+                        {
+                            "scope": {"name": "verdandi"},
+                            "spans": [
+                                span.to_otlp(self.trace_id)
+                                for span in self.spans
+                                if span.end_time is not None
+                            ],
+                        }
+                    ],
+                }
+            ]
+        }
+
+    def export(self, path: Path) -> asyncio.Future[None]:
+        """
+        Append the trace to a file in OTLP/JSON lines format, which can be
+        read by OpenTelemetry collector's file receiver. The file is written
+        in background.
+        """
+        line = json.dumps(self.to_otlp()) + "\n"
+
+        return asyncio.get_running_loop().run_in_executor(
+            export_executor,
+            _append_line,
+            path,
+            line,
+        )
+
+
+# Traces are appended by a single thread, which keeps them in order and the
+# disk out of the event loop
+export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-export")
+
+
+def _append_line(path: Path, line: str):
+    try:
+        with path.open("a") as file:
+            file.write(line)
+    except OSError:
+        logger.exception("Could not export trace to %s", path)
+
+
+current_trace: ContextVar[Trace | None] = ContextVar("current_trace", default=None)
+current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes: str) -> Iterator[Span | None]:
+    """
+    Record a span in the current trace, if any.
+    """
+    if (trace := current_trace.get()) is None:
+        yield None
+        return
+
+    parent = current_span.get()
+
+    res = Span(
+        name=name,
+        parent_span_id=None if parent is None else parent.span_id,
+        attributes=attributes,
+    )
+
+    trace.spans.append(res)
+    token = current_span.set(res)
+
+    try:
+        yield res
+    finally:
+        res.end_time = time_ns()
+        current_span.reset(token)
+
+
+def async_span[**P1, R1](
+    name: str,
+    **attributes: str,
+) -> Callable[[Callable[P1, Awaitable[R1]]], Callable[P1, Coroutine[None, None, R1]]]:
+    def decorator[**P2, R2](
+        func: Callable[P2, Awaitable[R2]],
+    ) -> Callable[P2, Coroutine[None, None, R2]]:
+        @functools.wraps(func)
+        async def wrapper(*args: P2.args, **kwargs: P2.kwargs) -> R2:
+            with span(name, **attributes):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
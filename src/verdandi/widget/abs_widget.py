@@ -1,8 +1,11 @@
 import asyncio
+import hashlib
 import logging
+import multiprocessing
 from abc import ABC, abstractmethod
+from concurrent.futures import Executor, ProcessPoolExecutor
 from datetime import datetime, timedelta
-from typing import ClassVar, Self
+from typing import Any, ClassVar, Self
 
 import aiohttp
 from PIL import Image
@@ -16,18 +19,100 @@ from tenacity import (
     wait_exponential,
 )
 
-from verdandi.metric.abs_metric import MetricConfig
+from verdandi.component.icon import preload_icons
+from verdandi.component.text import preload_fonts
+from verdandi.metric.abs_metric import Metric, MetricConfig
+from verdandi.util.breaker import CircuitOpenError
+from verdandi.util.cache import LruStore
 from verdandi.util.common import executor
-from verdandi.util.color import CW
-from verdandi.util.date import next_time_cadenced
+from verdandi.util.color import CD, CL, CW
+from verdandi.util.date import next_time_cadenced, prev_time_cadenced
+from verdandi.util.prometheus import Counter, Histogram
+from verdandi.util.tracing import span
 
 logger = logging.getLogger(__name__)
 
+FETCH_SECONDS = Histogram(
+    "verdandi_widget_fetch_seconds",
+    "Time spent fetching metrics of widgets.",
+    labels=("widget",),
+)
+
+DRAW_SECONDS = Histogram(
+    "verdandi_widget_draw_seconds",
+    "Time spent drawing widgets.",
+    labels=("widget",),
+)
+
+# Size of the corner drawn on widgets displaying stale metrics, in pixels
+STALE_MARKER_SIZE = 6
+
+METRIC_FALLBACKS = Counter(
+    "verdandi_metric_fallbacks",
+    "Metrics served from their last known value as they could not be loaded.",
+    labels=("metric",),
+)
+
+# Last value successfully loaded for metric configurations and requirements
+_last_known_good: LruStore[tuple[MetricConfig, Any], Metric] = LruStore(256)
+
+# Errors of upstreams which are served with the last known value of a metric,
+# others are most likely bugs
+UPSTREAM_ERRORS = (aiohttp.ClientError, CircuitOpenError, TimeoutError)
+
+
+def _init_render_worker():
+    """
+    Load resources shared by all widgets once per worker process.
+    """
+    preload_fonts()
+    preload_icons()
+
+
+def create_render_pool(processes: int) -> ProcessPoolExecutor:
+    """
+    Create a pool of processes that widgets can be drawn in, which allows
+    drawing to scale with available cores.
+    """
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_render_worker,
+    )
+
+
+def _draw_to_buffer(
+    widget: "Widget",
+    now: datetime,
+    metrics: dict[str, Metric],
+) -> tuple[str, tuple[int, int], bytes]:
+    img = widget._init_and_draw(now, **metrics)
+    return img.mode, img.size, img.tobytes()
+
 
 class Widget(ABC, BaseModel):
     name: ClassVar[str]
     size: ClassVar[tuple[int, int]]
 
+    # Period over which the drawing may change independently of its metrics,
+    # None if it only depends on its metrics.
+    time_granularity: ClassVar[timedelta | None] = None
+
+    # Fields of the metrics that are read while drawing, indexed by the name of
+    # the metric. All fields are assumed to be used for unlisted metrics.
+    metric_fields: ClassVar[dict[str, frozenset[str]]] = {}
+
+    # Requirements passed to the loader of metrics, indexed by the name of the
+    # field holding the metric's configuration. Loaders which support it can
+    # restrict the data they fetch accordingly.
+    metric_requirements: ClassVar[dict[str, Any]] = {}
+
+    def model_post_init(self, context):
+        # Share metric configurations with equal widgets of other devices
+        for field, value in self.__dict__.items():
+            if isinstance(value, MetricConfig):
+                self.__dict__[field] = value.intern()
+
     @classmethod
     def width(cls) -> int:
         return 133 * cls.size[0]
@@ -42,52 +127,201 @@ class Widget(ABC, BaseModel):
         """
         return next_time_cadenced(now, timedelta(hours=6))
 
+    def time_bucket(self, now: datetime) -> datetime | None:
+        """
+        Return the start of the period of time the drawing is valid for.
+        """
+        if self.time_granularity is None:
+            return None
+
+        return prev_time_cadenced(now, self.time_granularity)
+
+    def fingerprint(self, now: datetime, metrics: dict[str, Metric]) -> str:
+        """
+        Digest of all inputs of the drawing: two widgets with the same
+        fingerprint render to the same image.
+        """
+        time_bucket = self.time_bucket(now)
+
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self.name.encode())
+        digest.update(self.model_dump_json().encode())
+        digest.update((time_bucket.isoformat() if time_bucket else "").encode())
+
+        for name, metric in sorted(metrics.items()):
+            digest.update(name.encode())
+            digest.update(metric.fingerprint(self.metric_fields.get(name)).encode())
+            digest.update(b"stale" if metric.stale_since is not None else b"")
+
+        return digest.hexdigest()
+
     @classmethod
     @abstractmethod
     def example(cls) -> Self:
         raise NotImplementedError
 
     @abstractmethod
-    def draw(self, draw: ImageDraw, *args, **kwargs):
+    def draw(self, draw: ImageDraw, now: datetime, *args, **kwargs):
+        """
+        Draw the widget as it should be displayed at `now`, given its metrics
+        passed as keyword arguments.
+        """
         raise NotImplementedError
 
-    def _init_and_draw(self, **kwargs):
+    def placeholder(self) -> Image.Image:
+        """
+        Image displayed instead of the widget while its metrics are not loaded.
+        """
+        res = Image.new(mode="L", size=(self.width(), self.height()), color=CW)
+        ImageDraw(res).rectangle((0, 0, res.width - 1, res.height - 1), outline=CL)
+        return res
+
+    def _init_and_draw(self, now: datetime, **kwargs):
         res = Image.new(mode="L", size=(self.width(), self.height()), color=CW)
         draw = ImageDraw(res)
         draw.fontmode = "1"
-        self.draw(draw, **kwargs)
+        self.draw(draw, now, **kwargs)
+
+        # Mark widgets drawn from metrics which could not be refreshed
+        if any(
+            isinstance(metric, Metric) and metric.stale_since is not None
+            for metric in kwargs.values()
+        ):
+            draw.polygon(
+                [
+                    (res.width - STALE_MARKER_SIZE, 0),
+                    (res.width - 1, 0),
+                    (res.width - 1, STALE_MARKER_SIZE - 1),
+                ],
+                fill=CD,
+            )
+
         return res
 
-    async def render(self, http: aiohttp.ClientSession) -> Image.Image:
+    async def load_metrics(self, http: aiohttp.ClientSession) -> dict[str, Metric]:
+        """
+        Fetch all metrics required to draw this widget, indexed by the name of
+        the argument they are passed as to `draw`.
+
+        If a metric can't be loaded (eg. because the circuit breaker of its
+        upstream is open), its last known value is served, marked as stale.
+        """
+
+        # Transient DNS failures are retried shortly, longer outages are left
+        # to the circuit breakers of upstreams
         @retry(
             retry=retry_if_exception_type(aiohttp.ClientConnectorDNSError),
-            stop=stop_after_attempt(6),
-            wait=wait_exponential(min=1, max=8),
+            stop=stop_after_attempt(3),
+            wait=wait_exponential(multiplier=0.1, max=0.5),
             before_sleep=before_sleep_log(logger, logging.WARNING),
             reraise=True,
         )
+        async def load_from_upstream[M](
+            metric_config: MetricConfig[M],
+            requirements: Any,
+            http: aiohttp.ClientSession,
+        ) -> M:
+            if requirements is None:
+                return await metric_config.load(http)
+
+            return await metric_config.load(http, requirements)
+
         async def load_metric[M](
+            field: str,
             metric_config: MetricConfig[M],
             http: aiohttp.ClientSession,
         ) -> M:
-            return await metric_config.load(http)
-
-        # Fetch all metrics
-        metric_values = await asyncio.gather(
-            *(
-                load_metric(metric_config, http)
-                for metric_config in map(
-                    lambda field: getattr(self, field, None),
-                    type(self).model_fields,
+            requirements = self.metric_requirements.get(field)
+            key = (metric_config, requirements)
+
+            with span(
+                "load",
+                widget=type(self).__name__,
+                metric=type(metric_config).__name__,
+            ):
+                try:
+                    res = await load_from_upstream(metric_config, requirements, http)
+                except UPSTREAM_ERRORS as exc:
+                    if (last_known := _last_known_good.get(key)) is None:
+                        raise
+
+                    logger.warning(
+                        "Serving last known value of %s: %s",
+                        type(metric_config).__name__,
+                        exc,
+                    )
+
+                    METRIC_FALLBACKS.inc(metric=type(metric_config).__name__)
+                    return last_known.as_stale(last_known.loaded_at)  # ty: ignore[invalid-return-type]
+
+                _last_known_good.set(key, res)
+                return res
+
+        with (
+            FETCH_SECONDS.time(widget=type(self).__name__),
+            span("fetch", widget=type(self).__name__),
+        ):
+            metric_values = await asyncio.gather(
+                *(
+                    load_metric(field, metric_config, http)
+                    for field, metric_config in (
+                        (field, getattr(self, field, None))
+                        for field in type(self).model_fields
+                    )
+                    if isinstance(metric_config, MetricConfig)
                 )
-                if isinstance(metric_config, MetricConfig)
             )
-        )
 
+        return {val.name: val for val in metric_values}
+
+    async def draw_metrics(
+        self,
+        now: datetime,
+        metrics: dict[str, Metric],
+        render_pool: Executor | None = None,
+    ) -> Image.Image:
+        """
+        Draw the widget in a thread, or in a worker process of `render_pool`
+        if specified.
+        """
+        with (
+            DRAW_SECONDS.time(widget=type(self).__name__),
+            span("draw", widget=type(self).__name__),
+        ):
+            return await self._draw_metrics(now, metrics, render_pool)
+
+    async def _draw_metrics(
+        self,
+        now: datetime,
+        metrics: dict[str, Metric],
+        render_pool: Executor | None,
+    ) -> Image.Image:
         loop = asyncio.get_event_loop()
-        kwargs = {val.name: val for val in metric_values}
 
-        return await loop.run_in_executor(
-            executor,
-            lambda: self._init_and_draw(**kwargs),
+        if render_pool is None:
+            return await loop.run_in_executor(
+                executor,
+                lambda: self._init_and_draw(now, **metrics),
+            )
+
+        mode, size, data = await loop.run_in_executor(
+            render_pool,
+            _draw_to_buffer,
+            self,
+            now,
+            metrics,
         )
+
+        return Image.frombytes(mode, size, data)
+
+    async def render(
+        self,
+        http: aiohttp.ClientSession,
+        now: datetime | None = None,
+    ) -> Image.Image:
+        if now is None:
+            now = datetime.now().astimezone()
+
+        with span("render", widget=type(self).__name__):
+            metrics = await self.load_metrics(http)
+            return await self.draw_metrics(now, metrics)
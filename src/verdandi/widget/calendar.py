@@ -1,4 +1,4 @@
-from datetime import date, timedelta
+from datetime import datetime, timedelta
 
 from PIL.ImageDraw import ImageDraw
 from pydantic import AnyHttpUrl
@@ -18,6 +18,7 @@ CELL_WIDTH = 15
 class Calendar1x1(Widget):
     name = "calendar-1x1"
     size = (1, 1)
+    time_granularity = timedelta(days=1)
     ics: ICSConfig
 
     @classmethod
@@ -38,8 +39,8 @@ class Calendar1x1(Widget):
             )
         )
 
-    def draw(self, draw: ImageDraw, ics: ICSMetric):
-        today = date.today()
+    def draw(self, draw: ImageDraw, now: datetime, ics: ICSMetric):
+        today = now.date()
         month_start = today.replace(day=1)
         first_day = month_start - timedelta(days=month_start.weekday())
 
@@ -58,7 +59,7 @@ class Calendar1x1(Widget):
         for row in range(5):
             for col in range(7):
                 day = first_day + timedelta(days=row * 7 + col)
-                events = ics.on_date(day)
+                occupancy = ics.occupancy(day)
                 cell_x = MARGIN + col * (CELL_SPACING + CELL_WIDTH)
                 cell_y = MARGIN + row * (CELL_SPACING + CELL_HEIGHT) + 8
 
@@ -99,14 +100,13 @@ class Calendar1x1(Widget):
                     color=primary_color,
                 )
 
-                if any(event.is_full_day(day) for event in events):
+                if occupancy.full_day:
                     line_pos_y = cell_y + 2
 
                     # If the only full day events are birthdays, draw a dashed line
                     only_birthday = not any(
-                        event.is_full_day(day)
-                        and summary_to_category(event.summary) != "present"
-                        for event in events
+                        summary_to_category(event.summary) != "present"
+                        for event in occupancy.full_day
                     )
 
                     draw.point(
@@ -121,11 +121,7 @@ class Calendar1x1(Widget):
                         fill=primary_color,
                     )
 
-                for event in events:
-                    if event.is_full_day(day):
-                        continue
-
-                    period = event.day_period(day)
+                for period, _ in occupancy.periods:
                     rect_x = cell_x + 2 + 3 * period.value
                     rect_y = cell_y + 14
 
@@ -1,4 +1,4 @@
-from datetime import date
+from datetime import date, datetime, timedelta
 
 from pydantic import Field
 from PIL.ImageDraw import ImageDraw
@@ -14,6 +14,7 @@ MARGIN = 6
 class Countdown2x1(Widget):
     name = "countdown-2x1"
     size = (2, 1)
+    time_granularity = timedelta(days=1)
     title: str = Field(description="title displayed on top of the widget")
     date_start: date = Field(description="countdown start")
     date_end: date = Field(description="countdown end")
@@ -26,19 +27,19 @@ class Countdown2x1(Widget):
             date_end=date.fromisoformat("2030-01-01"),
         )
 
-    def draw(self, draw: ImageDraw):
-        now = date.today()
+    def draw(self, draw: ImageDraw, now: datetime):
+        today = now.date()
 
-        if now < self.date_end:
-            remaining = (self.date_end - now).days
+        if today < self.date_end:
+            remaining = (self.date_end - today).days
             text = f"{remaining} jours restants"
         else:
-            elapsed = (now - self.date_end).days
+            elapsed = (today - self.date_end).days
             text = f"{elapsed} jours passés"
 
         progress = min(
             1.0,
-            (now - self.date_start) / (self.date_end - self.date_start),
+            (today - self.date_start) / (self.date_end - self.date_start),
         )
 
         draw_text(draw, (MARGIN, 1), Font.LARGE_BOLD, self.title)
@@ -1,7 +1,9 @@
-from verdandi.widget.abs_widget import Widget
+from datetime import datetime
 
 from PIL.ImageDraw import ImageDraw
 
+from verdandi.widget.abs_widget import Widget
+
 from verdandi.component.icon import list_icons, icon_size, draw_icon
 
 MARGIN = 5
@@ -16,7 +18,7 @@ class DebugIcons3x4(Widget):
     def example(cls) -> "DebugIcons3x4":
         return DebugIcons3x4()
 
-    def draw(self, draw: ImageDraw):
+    def draw(self, draw: ImageDraw, now: datetime):
         icons = list_icons()
         icons.sort(key=lambda icon: icon_size(icon)[0], reverse=True)
 
@@ -1,4 +1,4 @@
-from datetime import timedelta, date, datetime, time
+from datetime import timedelta, datetime, time
 
 from pydantic import AnyHttpUrl
 from PIL import Image
@@ -40,6 +40,7 @@ SHADE_TIMELINE_BACKGROUND = ShadeMatrix(
 class Schedule3x4(Widget):
     name = "schedule-3x4"
     size = (3, 4)
+    time_granularity = timedelta(days=1)
     ics: ICSConfig
 
     @classmethod
@@ -60,31 +61,18 @@ class Schedule3x4(Widget):
             )
         )
 
-    def draw(self, draw: ImageDraw, ics: ICSMetric):
+    def draw(self, draw: ImageDraw, now: datetime, ics: ICSMetric):
         SHADE_TIMELINE_BACKGROUND.fill_rect(
             draw,
             (MARGIN, MARGIN, MARGIN + 17, self.height() - 2 * MARGIN),
         )
 
-        today = date.today()
-        events_per_day = {}
-
-        for event in ics.upcoming:
-            date_curr = event.date_start.date()
-
-            if event.date_start < event.date_end:
-                date_end = (event.date_end - timedelta(seconds=1)).date()
-            else:
-                date_end = date_curr
-
-            while date_curr <= date_end:
-                events_per_day.setdefault(date_curr, []).append(event)
-                date_curr += timedelta(days=1)
-
+        today = now.date()
         y_pos = MARGIN
         prev_day = None
 
-        for day, events in iter(events_per_day.items()):
+        # Days are expanded only as long as they fit in the widget
+        for day, events in ics.iter_days(now):
             if y_pos > self.height() - (24 + MARGIN_DAY):
                 break
 
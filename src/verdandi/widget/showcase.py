@@ -1,5 +1,5 @@
 import logging
-from datetime import date, datetime
+from datetime import date, datetime, time, timedelta
 from zoneinfo import ZoneInfo
 
 from pydantic import AnyHttpUrl
@@ -30,6 +30,7 @@ SHADE_PROGRESS = ShadeMatrix(
 class Showcase2x1(Widget):
     name = "showcase-2x1"
     size = (2, 1)
+    time_granularity = timedelta(days=1)
     ics: ICSConfig
 
     @classmethod
@@ -50,9 +51,9 @@ class Showcase2x1(Widget):
             )
         )
 
-    def draw(self, draw: ImageDraw, ics: ICSMetric):
+    def draw(self, draw: ImageDraw, now: datetime, ics: ICSMetric):
         tz = ZoneInfo(self.ics.timezone)
-        now = datetime.now(tz)
+        now = now.astimezone(tz)
         year_start = date(now.year, 1, 1)
         year_end = date(now.year + 1, 1, 1)
 
@@ -89,14 +90,16 @@ class Showcase2x1(Widget):
             icon_x = bar_x_start + int(year_progress * (bar_x_end - bar_x_start))
             draw_icon(draw, (icon_x - 8, 60), "small-" + icon)
 
-        # == Display next event
-        event = ics.next_showcase_event(now)
+        # == Display next event, the drawing is shared by the whole day so it
+        # only depends on dates
+        today = now.date()
+        event = ics.next_showcase_event(datetime.combine(today, time(), tz))
 
         if event is None:
             logger.warning("No showcase event was found")
             return
 
-        remaining = (event.date_start - now).days + 1
+        remaining = max(0, (event.date_start.date() - today).days)
         title_x = MARGIN
 
         match remaining:
@@ -6,7 +6,7 @@ from verdandi.component.curve import draw_curve
 from verdandi.component.icon import draw_icon
 from verdandi.component.progress import draw_vertical_pill
 from verdandi.component.text import Font, draw_text
-from verdandi.metric.weather import WeatherConfig, WeatherMetric
+from verdandi.metric.weather import WeatherConfig, WeatherMetric, WeatherRequirements
 from verdandi.util.color import CB, CD, CL, CW
 from verdandi.util.date import next_time_cadenced, weekday_humanized
 from verdandi.util.draw import ShadeMatrix
@@ -43,6 +43,11 @@ DASHED_SCALE = ShadeMatrix(DASHED_LINE, [CW], DASHED_LINE, [CW])
 class WeatherRecap3x2(Widget):
     name = "weather-recap-3x2"
     size = (3, 2)
+
+    # Hourly table spans 24 hours from the current hour, indexed from midnight
+    # (up to hourly[47])
+    metric_requirements = {"weather": WeatherRequirements(daily_days=1, hourly_days=2)}
+
     weather: WeatherConfig
 
     def next_update(self, now: datetime) -> datetime:
@@ -58,7 +63,9 @@ class WeatherRecap3x2(Widget):
             )
         )
 
-    def draw(self, draw: ImageDraw, weather: WeatherMetric):
+    def draw(self, draw: ImageDraw, now: datetime, weather: WeatherMetric):
+        assert weather.hourly is not None
+
         # Get biggest hour of the day that's before current time
         curr_date = weather.time.date()
         curr_time = weather.time.time()
@@ -152,11 +159,14 @@ class WeatherRecap3x2(Widget):
             if temp % scale_precision == 0
         ]
 
-        # Section: hourly
-        def temp_func(x: float) -> float:
-            dt = curr_dt + timedelta(hours=24.0 * x)
-            temp = weather.interpolate_temperature_at(dt)
-            return temp_y_coord(temp)
+        curve_x_pos = 20
+
+        # Section: hourly, with one value per column of the curve
+        temperatures = weather.hourly.interpolate_temperatures(
+            curr_dt,
+            curr_dt + timedelta(hours=24.0),
+            self.width() - 2 * curve_x_pos + 1,
+        )
 
         # Shade the curve between sunset & surise
         next_date = curr_date + timedelta(days=1)
@@ -183,12 +193,10 @@ class WeatherRecap3x2(Widget):
             )
         )
 
-        curve_x_pos = 20
-
         draw_curve(
             draw,
             (curve_x_pos, 90, self.width() - curve_x_pos, 150),
-            temp_func,
+            [temp_y_coord(temp) for temp in temperatures],
             shade_parts,
             y_scale=displayed_scale,
             y_origin=temp_y_coord(0.0),
@@ -244,6 +252,8 @@ class WeatherRecap3x2(Widget):
 class WeatherWeek3x1(Widget):
     name = "weather-week-3x1"
     size = (3, 1)
+    metric_fields = {"weather": frozenset({"daily"})}
+    metric_requirements = {"weather": WeatherRequirements(daily_days=7, hourly_days=0)}
     weather: WeatherConfig
 
     @classmethod
@@ -256,7 +266,7 @@ class WeatherWeek3x1(Widget):
             )
         )
 
-    def draw(self, draw: ImageDraw, weather: WeatherMetric):
+    def draw(self, draw: ImageDraw, now: datetime, weather: WeatherMetric):
         cell_width = 128
         cell_height = 50
 